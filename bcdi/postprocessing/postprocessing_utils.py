@@ -320,13 +320,8 @@ def blackman_window(shape):
     array_z = np.blackman(nbz)
     array_y = np.blackman(nby)
     array_x = np.blackman(nbx)
-    blackman2 = np.ones((nbz, nby))
-    blackman3 = np.ones((nbz, nby, nbx))
-    for idz in range(nbz):
-        blackman2[idz, :] = array_z[idz] * array_y
-        for idy in range(nby):
-            blackman3[idz, idy] = blackman2[idz, idy] * array_x
-    return blackman3
+    # the window is separable, broadcast the outer product of the 1D windows
+    return array_z[:, np.newaxis, np.newaxis] * array_y[np.newaxis, :, np.newaxis] * array_x[np.newaxis, np.newaxis, :]
 
 
 def bragg_temperature(spacing, reflection, spacing_ref=None, temperature_ref=None, use_q=False, material=None):
@@ -508,40 +503,31 @@ def crop_pad(array, output_shape, padwith_ones=False, start=(np.nan, np.nan, np.
         gu.multislices_plot(abs(array), width_z=width_z, width_y=width_y, width_x=width_x, title='Before crop/pad')
     # z
     if newz >= nbz:  # pad
-        if not padwith_ones:
-            temp_z = np.zeros((output_shape[0], nby, nbx), dtype=array.dtype)
-        else:
-            temp_z = np.ones((output_shape[0], nby, nbx), dtype=array.dtype)
-        if np.isnan(start[0]):
-            temp_z[(newz - nbz) // 2:(newz + nbz) // 2, :, :] = array
-        else:
-            temp_z[start[0]:start[0]+nbz, :, :] = array
+        start_z = (newz - nbz) // 2 if np.isnan(start[0]) else start[0]
+        crop_z, pad_z = np.s_[:], np.s_[start_z:start_z + nbz]
     else:  # crop
-        temp_z = array[(nbz - newz) // 2:(newz + nbz) // 2, :, :]
+        crop_z, pad_z = np.s_[(nbz - newz) // 2:(newz + nbz) // 2], np.s_[:]
     # y
     if newy >= nby:  # pad
-        if not padwith_ones:
-            temp_y = np.zeros((newz, newy, nbx), dtype=array.dtype)
-        else:
-            temp_y = np.ones((newz, newy, nbx), dtype=array.dtype)
-        if np.isnan(start[1]):
-            temp_y[:, (newy - nby) // 2:(newy + nby) // 2, :] = temp_z
-        else:
-            temp_y[:, start[1]:start[1]+nby, :] = temp_z
+        start_y = (newy - nby) // 2 if np.isnan(start[1]) else start[1]
+        crop_y, pad_y = np.s_[:], np.s_[start_y:start_y + nby]
     else:  # crop
-        temp_y = temp_z[:, (nby - newy) // 2:(newy + nby) // 2, :]
+        crop_y, pad_y = np.s_[(nby - newy) // 2:(newy + nby) // 2], np.s_[:]
     # x
     if newx >= nbx:  # pad
+        start_x = (newx - nbx) // 2 if np.isnan(start[2]) else start[2]
+        crop_x, pad_x = np.s_[:], np.s_[start_x:start_x + nbx]
+    else:  # crop
+        crop_x, pad_x = np.s_[(nbx - newx) // 2:(newx + nbx) // 2], np.s_[:]
+
+    if newz < nbz and newy < nby and newx < nbx:  # crop only, this is a view of the array
+        newobj = array[crop_z, crop_y, crop_x]
+    else:  # allocate the output once and copy the cropped array at its position
         if not padwith_ones:
             newobj = np.zeros((newz, newy, newx), dtype=array.dtype)
         else:
             newobj = np.ones((newz, newy, newx), dtype=array.dtype)
-        if np.isnan(start[2]):
-            newobj[:, :, (newx - nbx) // 2:(newx + nbx) // 2] = temp_y
-        else:
-            newobj[:, :, start[2]:start[2]+nbx] = temp_y
-    else:  # crop
-        newobj = temp_y[:, :, (nbx - newx) // 2:(newx + nbx) // 2]
+        newobj[pad_z, pad_y, pad_x] = array[crop_z, crop_y, crop_x]
 
     if debugging:
         gu.multislices_plot(abs(newobj), width_z=width_z, width_y=width_y, width_x=width_x, title='After crop/pad')
@@ -574,28 +560,25 @@ def crop_pad_2d(array, output_shape, padwith_ones=False, start=(np.nan, np.nan),
         gu.imshow_plot(abs(array), width_v=width_y, width_h=width_x, title='Before crop/pad')
     # y
     if newy >= nby:  # pad
-        if not padwith_ones:
-            temp_y = np.zeros((output_shape[0], nbx), dtype=array.dtype)
-        else:
-            temp_y = np.ones((output_shape[0], nbx), dtype=array.dtype)
-        if np.isnan(start[0]):
-            temp_y[(newy - nby) // 2:(newy + nby) // 2, :] = array
-        else:
-            temp_y[start[0]:start[0]+nby, :] = array
+        start_y = (newy - nby) // 2 if np.isnan(start[0]) else start[0]
+        crop_y, pad_y = np.s_[:], np.s_[start_y:start_y + nby]
     else:  # crop
-        temp_y = array[(nby - newy) // 2:(newy + nby) // 2, :]
+        crop_y, pad_y = np.s_[(nby - newy) // 2:(newy + nby) // 2], np.s_[:]
     # x
     if newx >= nbx:  # pad
+        start_x = (newx - nbx) // 2 if np.isnan(start[1]) else start[1]
+        crop_x, pad_x = np.s_[:], np.s_[start_x:start_x + nbx]
+    else:  # crop
+        crop_x, pad_x = np.s_[(nbx - newx) // 2:(newx + nbx) // 2], np.s_[:]
+
+    if newy < nby and newx < nbx:  # crop only, this is a view of the array
+        newobj = array[crop_y, crop_x]
+    else:  # allocate the output once and copy the cropped array at its position
         if not padwith_ones:
             newobj = np.zeros((newy, newx), dtype=array.dtype)
         else:
             newobj = np.ones((newy, newx), dtype=array.dtype)
-        if np.isnan(start[1]):
-            newobj[:, (newx - nbx) // 2:(newx + nbx) // 2] = temp_y
-        else:
-            newobj[:, start[1]:start[1]+nbx] = temp_y
-    else:  # crop
-        newobj = temp_y[:, (nbx - newx) // 2:(newx + nbx) // 2]
+        newobj[pad_y, pad_x] = array[crop_y, crop_x]
 
     if debugging:
         gu.imshow_plot(abs(array), width_v=width_y, width_h=width_x, title='After crop/pad')
@@ -1656,13 +1639,8 @@ def tukey_window(shape, alpha=np.array([0.5, 0.5, 0.5])):
     array_z = tukey(nbz, alpha[0])
     array_y = tukey(nby, alpha[1])
     array_x = tukey(nbx, alpha[2])
-    tukey2 = np.ones((nbz, nby))
-    tukey3 = np.ones((nbz, nby, nbx))
-    for idz in range(nbz):
-        tukey2[idz, :] = array_z[idz] * array_y
-        for idy in range(nby):
-            tukey3[idz, idy] = tukey2[idz, idy] * array_x
-    return tukey3
+    # the window is separable, broadcast the outer product of the 1D windows
+    return array_z[:, np.newaxis, np.newaxis] * array_y[np.newaxis, :, np.newaxis] * array_x[np.newaxis, np.newaxis, :]
 
 
 def unwrap(obj, support_threshold, debugging=True):
@@ -9,7 +9,7 @@
 import hdf5plugin  # for P10, should be imported before h5py or PyTables
 import numpy as np
 from matplotlib import pyplot as plt
-from scipy.interpolate import interp1d
+from scipy.interpolate import CubicSpline
 import tkinter as tk
 from tkinter import filedialog
 import sys
@@ -170,10 +170,8 @@ if numz != nb_frames:
 #######################
 # Find the Bragg peak #
 #######################
-z0, y0, x0 = pru.find_bragg(data, peak_method=peak_method)
-z0 = np.rint(z0).astype(int)
-y0 = np.rint(y0).astype(int)
-x0 = np.rint(x0).astype(int)
+# round half to even like np.rint, without going through NumPy for three scalars
+z0, y0, x0 = [round(float(val)) for val in pru.find_bragg(data, peak_method=peak_method)]
 
 print("Bragg peak at (z, y, x): ", z0, y0, x0)
 print("Bragg peak (full detector) at (z, y, x): ", z0, y0+detector.roi[0], x0+detector.roi[2])
@@ -181,23 +179,21 @@ print("Bragg peak (full detector) at (z, y, x): ", z0, y0+detector.roi[0], x0+de
 ######################################################
 # calculate rocking curve and fit it to get the FWHM #
 ######################################################
-rocking_curve = np.zeros(nb_frames)
 if filtered_data == 0:  # take a small ROI to avoid parasitic peaks
-    for idx in range(nb_frames):
-        rocking_curve[idx] = data[idx, y0 - 20:y0 + 20, x0 - 20:x0 + 20].sum()
+    rocking_curve = data[:, y0 - 20:y0 + 20, x0 - 20:x0 + 20].sum(axis=(1, 2), dtype=np.float64)
     plot_title = "Rocking curve for a 40x40 pixels ROI"
 else:  # take the whole detector
-    for idx in range(nb_frames):
-        rocking_curve[idx] = data[idx, :, :].sum()
+    rocking_curve = data.sum(axis=(1, 2), dtype=np.float64)
     plot_title = "Rocking curve (full detector)"
 z0 = np.unravel_index(rocking_curve.argmax(), rocking_curve.shape)[0]
 
 
-interpolation = interp1d(tilt, rocking_curve, kind='cubic')
+order = np.argsort(tilt)  # the rocking angle can be scanned in both directions, CubicSpline needs it increasing
+interpolation = CubicSpline(tilt[order], rocking_curve[order])
 interp_points = 5*nb_frames
 interp_tilt = np.linspace(tilt.min(), tilt.max(), interp_points)
 interp_curve = interpolation(interp_tilt)
-interp_fwhm = len(np.argwhere(interp_curve >= interp_curve.max()/2)) * \
+interp_fwhm = np.count_nonzero(interp_curve >= interp_curve.max()/2) * \
               (tilt.max()-tilt.min())/(interp_points-1)
 print('FWHM by interpolation', str('{:.3f}'.format(interp_fwhm)), 'deg')
 
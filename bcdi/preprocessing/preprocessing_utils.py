@@ -9,9 +9,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 from scipy.ndimage.measurements import center_of_mass
+from scipy.ndimage import correlate1d
 from scipy.interpolate import RegularGridInterpolator
 import xrayutilities as xu
 from operator import itemgetter
+from functools import lru_cache
+from math import isqrt
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import fabio
 import os
 import sys
@@ -21,6 +26,77 @@ import bcdi.postprocessing.postprocessing_utils as pu
 from bcdi.utils import image_registration as reg
 
 
+def _build_mask3d(data, mask_2d):
+    """
+    Broadcast the 2D mask to all frames and mask NaN values of the data, which are set to 0.
+
+    :param data: the 3D data array, modified in place
+    :param mask_2d: the 2D mask, common to all frames
+    :return: the data and the 3D mask as a uint8 array
+    """
+    mask3d = np.empty(data.shape, dtype=np.uint8)
+    nan_data = np.isnan(data)
+    if nan_data.any():  # scan the boolean array only, data is not touched again in the usual case without NaN
+        np.copyto(data, 0, where=nan_data)
+        np.bitwise_or(mask_2d, nan_data, out=mask3d)  # broadcast the 2D mask and add NaN pixels in a single pass
+    else:
+        mask3d[...] = mask_2d  # broadcast the 2D mask to all frames
+    return data, mask3d
+
+
+def _correct_frames(frames, flatfield, background, mask_2d, masked_values, out=None):
+    """
+    Subtract the background, apply the flatfield correction and set masked pixels to their masked value.
+
+    :param frames: a 2D frame or a 3D stack of frames, restricted to the region of interest
+    :param flatfield: the 2D flatfield array restricted to the region of interest, None to skip the correction
+    :param background: the 2D background array restricted to the region of interest, None to skip the subtraction
+    :param mask_2d: the 2D mask restricted to the region of interest
+    :param masked_values: the 2D array of values taken by masked pixels, restricted to the region of interest
+    :param out: float32 array where to write the corrected frames, allocated if None
+    :return: the corrected frames
+    """
+    if out is None:
+        out = np.empty(frames.shape, dtype=np.float32)
+    if background is not None:
+        np.subtract(frames, background, out=out)
+    else:
+        out[...] = frames
+    if flatfield is not None:
+        out *= flatfield
+    np.copyto(out, masked_values, where=mask_2d != 0)
+    return out
+
+
+def _read_fabio_frames(file_list, detector, flatfield, background, mask_2d, masked_values):
+    """
+    Read detector images with fabio, crop them to the region of interest and apply the background, flatfield and
+    masked pixels corrections.
+
+    :param file_list: list of the paths of the images, one image per frame
+    :param detector: the detector object: Class experiment_utils.Detector()
+    :param flatfield: the 2D flatfield array restricted to the region of interest, None to skip the correction
+    :param background: the 2D background array restricted to the region of interest, None to skip the subtraction
+    :param mask_2d: the 2D mask restricted to the region of interest
+    :param masked_values: the 2D array of values taken by masked pixels, restricted to the region of interest
+    :return: the 3D data array of the corrected frames
+    """
+    nb_img = len(file_list)
+    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]), dtype=np.float32)
+
+    # read the images in parallel (fabio releases the GIL while reading files), by batches of nb_workers images
+    # to bound the number of full detector images held in memory. Each frame is cropped and corrected (background,
+    # flatfield and masked pixels) as soon as it is read, while it is still in cache
+    nb_workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        for start in range(0, nb_img, nb_workers):
+            for idx, e in enumerate(executor.map(fabio.open, file_list[start:start + nb_workers]), start=start):
+                _correct_frames(frames=e.data[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]],
+                                flatfield=flatfield, background=background, mask_2d=mask_2d,
+                                masked_values=masked_values, out=data[idx, :, :])
+    return data
+
+
 def align_diffpattern(reference_data, data, mask=None, method='registration', combining_method='rgi'):
     """
     Align two diffraction patterns based on the shift of the center of mass or based on dft registration.
@@ -254,7 +330,8 @@ def bin_parameters(binning, nb_frames, params, debugging=True):
             except TypeError:  # int or float
                 params[idx] = np.repeat(params[idx], nb_frames)
             temp = params[idx]
-            params[idx] = temp[::binning]
+            # contiguous float64 copy of the strided selection, as expected by xrayutilities Ang2Q.area()
+            params[idx] = np.ascontiguousarray(temp[::binning], dtype=np.float64)
 
     if debugging:
         print(params)
@@ -303,51 +380,40 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
     if data.shape != mask.shape:
         raise ValueError('Data and mask must have the same shape\n data is ', data.shape, ' while mask is ', mask.shape)
 
-    for k in kwargs.keys():
-        if k in ['fix_bragg']:
-            fix_bragg = kwargs['fix_bragg']
-        elif k in ['fix_size']:
-            fix_size = kwargs['fix_size']
-        elif k in ['pad_size']:
-            pad_size = kwargs['pad_size']
-        elif k in ['q_values']:
-            q_values = kwargs['q_values']
-        else:
-            raise Exception("unknown keyword argument given: allowed is"
-                            "'fix_bragg', 'fix_size', 'pad_size' and 'q_values'")
-    try:
-        fix_bragg
-    except NameError:  # fix_bragg not declared
-        fix_bragg = []
-    try:
-        fix_size
-    except NameError:  # fix_size not declared
-        fix_size = []
-    try:
-        pad_size
-    except NameError:  # pad_size not declared
-        pad_size = []
-    try:
-        q_values
+    fix_bragg = kwargs.pop('fix_bragg', [])
+    fix_size = kwargs.pop('fix_size', [])
+    pad_size = kwargs.pop('pad_size', [])
+    q_values = kwargs.pop('q_values', [])
+    if kwargs:
+        raise TypeError("unknown keyword argument given: allowed is "
+                        "'fix_bragg', 'fix_size', 'pad_size' and 'q_values'")
+    if len(q_values) != 0:
         qx = q_values[0]  # axis=0, z downstream, qx in reciprocal space
         qz = q_values[1]  # axis=1, y vertical, qz in reciprocal space
         qy = q_values[2]  # axis=2, x outboard, qy in reciprocal space
-    except NameError:  # q_values not declared
-        q_values = []
-        qx = []
-        qy = []
-        qz = []
-    except IndexError:  # q_values empty
-        q_values = []
-        qx = []
-        qy = []
-        qz = []
+    else:
+        qx, qz, qy = [], [], []
 
     if centering == 'max':
-        z0, y0, x0 = np.unravel_index(abs(data).argmax(), data.shape)
+        if np.iscomplexobj(data) or data.min() < 0:
+            position = abs(data).argmax()
+        else:  # diffraction intensity is positive, avoid allocating abs(data)
+            position = data.argmax()
+        z0, y0, x0 = [int(val) for val in np.unravel_index(position, data.shape)]  # unravel only the reduced index
         print("Max at (qx, qz, qy): ", z0, y0, x0)
     elif centering == 'com':
-        z0, y0, x0 = center_of_mass(data)
+        # barycenters of the 1D projections, avoids the full-size temporary arrays of center_of_mass()
+        # both projections are accumulated slab by slab, each slab being read once while it stays in cache
+        slab = max(1, 2**18 // (data.shape[1] * data.shape[2]))  # number of frames in a slab of ~2**18 voxels
+        profile_z = np.empty(data.shape[0])
+        projection_yx = np.zeros(data.shape[1:])
+        for start in range(0, data.shape[0], slab):
+            profile_z[start:start + slab] = data[start:start + slab].sum(axis=(1, 2), dtype=np.float64)
+            projection_yx += data[start:start + slab].sum(axis=0, dtype=np.float64)
+        total = profile_z.sum()
+        z0 = np.dot(profile_z, np.arange(data.shape[0])) / total
+        y0 = np.dot(projection_yx.sum(axis=1), np.arange(data.shape[1])) / total
+        x0 = np.dot(projection_yx.sum(axis=0), np.arange(data.shape[2])) / total
         print("Center of mass at (qx, qz, qy): ", z0, y0, x0)
     else:
         raise ValueError("Incorrect value for 'centering' parameter")
@@ -361,8 +427,12 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
         x0 = (x0 - detector.roi[2]) / detector.binning[2]
         print("Bragg peak position after considering detector ROI and binning in detector plane: ", z0, y0, x0)
 
-    iz0, iy0, ix0 = int(round(z0)), int(round(y0)), int(round(x0))
-    print('data at Bragg peak = ', data[iz0, iy0, ix0])
+    if centering == 'max' and len(fix_bragg) == 0:
+        iz0, iy0, ix0 = z0, y0, x0  # already integer indices
+        print('data at Bragg peak = ', data.flat[position])  # use the linear index of the maximum
+    else:
+        iz0, iy0, ix0 = int(round(z0)), int(round(y0)), int(round(x0))
+        print('data at Bragg peak = ', data[iz0, iy0, ix0])
 
     # Max symmetrical box around center of mass
     nbz, nby, nbx = np.shape(data)
@@ -375,45 +445,23 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
         fft_option = 'do_nothing'
 
     # Crop/pad data to fulfill FFT size and user requirements
+    # each option defines the range [start:stop] of the original array which is kept along each axis,
+    # and the number of pixels pad_width = [z0, z1, y0, y1, x0, x1] added at each end after cropping
+    start = [0, 0, 0]
+    stop = [nbz, nby, nbx]
+    pad_width = np.zeros(6, dtype=int)
+
     if fft_option == 'crop_sym_ZYX':
         # crop rocking angle and detector, Bragg peak centered
         nz1, ny1, nx1 = smaller_primes((max_nz, max_ny, max_nx), maxprime=7, required_dividers=(2,))
-        pad_width = np.zeros(6, dtype=int)
-
-        data = data[iz0 - nz1 // 2:iz0 + nz1//2, iy0 - ny1//2:iy0 + ny1//2, ix0 - nx1//2:ix0 + nx1//2]
-        mask = mask[iz0 - nz1 // 2:iz0 + nz1//2, iy0 - ny1//2:iy0 + ny1//2, ix0 - nx1//2:ix0 + nx1//2]
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        if (iz0 - nz1//2) > 0:  # if 0, the first frame is used
-            frames_logical[0:iz0 - nz1 // 2] = 0
-        if (iz0 + nz1 // 2) < nbz:  # if nbz, the last frame is used
-            frames_logical[iz0 + nz1 // 2:] = 0
-
-        if len(q_values) != 0:
-            qx = qx[iz0 - nz1//2:iz0 + nz1//2]
-            qy = qy[ix0 - nx1//2:ix0 + nx1//2]
-            qz = qz[iy0 - ny1//2:iy0 + ny1//2]
+        start = [iz0 - nz1//2, iy0 - ny1//2, ix0 - nx1//2]
+        stop = [iz0 + nz1//2, iy0 + ny1//2, ix0 + nx1//2]
 
     elif fft_option == 'crop_asym_ZYX':
         # crop rocking angle and detector without centering the Bragg peak
         nz1, ny1, nx1 = smaller_primes((nbz, nby, nbx), maxprime=7, required_dividers=(2,))
-        pad_width = np.zeros(6, dtype=int)
-
-        data = data[nbz//2 - nz1//2:nbz//2 + nz1//2, nby//2 - ny1//2:nby//2 + ny1//2,
-                    nbx//2 - nx1//2:nbx//2 + nx1//2]
-        mask = mask[nbz//2 - nz1//2:nbz//2 + nz1//2, nby//2 - ny1//2:nby//2 + ny1//2,
-                    nbx//2 - nx1//2:nbx//2 + nx1//2]
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        if (nbz//2 - nz1//2) > 0:  # if 0, the first frame is used
-            frames_logical[0:nbz//2 - nz1//2] = 0
-        if (nbz//2 + nz1//2) < nbz:  # if nbz, the last frame is used
-            frames_logical[nbz//2 + nz1 // 2:] = 0
-
-        if len(q_values) != 0:
-            qx = qx[nbz//2 - nz1//2:nbz//2 + nz1//2]
-            qy = qy[nbx//2 - nx1//2:nbx//2 + nx1//2]
-            qz = qz[nby//2 - ny1//2:nby//2 + ny1//2]
+        start = [nbz//2 - nz1//2, nby//2 - ny1//2, nbx//2 - nx1//2]
+        stop = [nbz//2 + nz1//2, nby//2 + ny1//2, nbx//2 + nx1//2]
 
     elif fft_option == 'pad_sym_Z_crop_sym_YX':
         # pad rocking angle based on 'pad_size' (Bragg peak centered) and crop detector (Bragg peak centered)
@@ -422,26 +470,10 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
         if pad_size[0] != higher_primes(pad_size[0], maxprime=7, required_dividers=(2,)):
             raise ValueError(pad_size[0], 'does not meet FFT requirements')
         ny1, nx1 = smaller_primes((max_ny, max_nx), maxprime=7, required_dividers=(2,))
-
-        data = data[:, iy0 - ny1//2:iy0 + ny1//2, ix0 - nx1//2:ix0 + nx1//2]
-        mask = mask[:, iy0 - ny1//2:iy0 + ny1//2, ix0 - nx1//2:ix0 + nx1//2]
-        pad_width = np.array([int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)),
-                              int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz)),
-                              0, 0, 0, 0], dtype=int)
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qx = qx0 + np.arange(pad_size[0])*dqx
-            qy = qy[ix0 - nx1 // 2:ix0 + nx1 // 2]
-            qz = qz[iy0 - ny1 // 2:iy0 + ny1 // 2]
+        start[1:] = [iy0 - ny1//2, ix0 - nx1//2]
+        stop[1:] = [iy0 + ny1//2, ix0 + nx1//2]
+        pad_width[0:2] = [int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)),
+                          int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz))]
 
     elif fft_option == 'pad_sym_Z_crop_asym_YX':
         # pad rocking angle based on 'pad_size' (Bragg peak centered) and crop detector (Bragg peak non-centered)
@@ -451,74 +483,26 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
         if pad_size[0] != higher_primes(pad_size[0], maxprime=7, required_dividers=(2,)):
             raise ValueError(pad_size[0], 'does not meet FFT requirements')
         ny1, nx1 = smaller_primes((max_ny, max_nx), maxprime=7, required_dividers=(2,))
-
-        data = data[:, nby//2 - ny1//2:nby//2 + ny1//2, nbx//2 - nx1//2:nbx//2 + nx1//2]
-        mask = mask[:, nby//2 - ny1//2:nby//2 + ny1//2, nbx//2 - nx1//2:nbx//2 + nx1//2]
-        pad_width = np.array([int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)),
-                              int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz)),
-                              0, 0, 0, 0], dtype=int)
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qx = qx0 + np.arange(pad_size[0])*dqx
-            qy = qy[nbx//2 - nx1//2:nbx//2 + nx1//2]
-            qz = qz[nby//2 - ny1//2:nby//2 + ny1//2]
+        start[1:] = [nby//2 - ny1//2, nbx//2 - nx1//2]
+        stop[1:] = [nby//2 + ny1//2, nbx//2 + nx1//2]
+        pad_width[0:2] = [int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)),
+                          int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz))]
 
     elif fft_option == 'pad_asym_Z_crop_sym_YX':
         # pad rocking angle without centering the Bragg peak and crop detector (Bragg peak centered)
         ny1, nx1 = smaller_primes((max_ny, max_nx), maxprime=7, required_dividers=(2,))
         nz1 = higher_primes(nbz, maxprime=7, required_dividers=(2,))
-
-        data = data[:, iy0 - ny1//2:iy0 + ny1//2, ix0 - nx1//2:ix0 + nx1//2]
-        mask = mask[:, iy0 - ny1//2:iy0 + ny1//2, ix0 - nx1//2:ix0 + nx1//2]
-        pad_width = np.array([int((nz1 - nbz + ((nz1 - nbz) % 2)) / 2), int((nz1 - nbz + 1) / 2 - ((nz1 - nbz) % 2)),
-                              0, 0, 0, 0], dtype=int)
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qx = qx0 + np.arange(nz1)*dqx
-            qy = qy[ix0 - nx1 // 2:ix0 + nx1 // 2]
-            qz = qz[iy0 - ny1 // 2:iy0 + ny1 // 2]
+        start[1:] = [iy0 - ny1//2, ix0 - nx1//2]
+        stop[1:] = [iy0 + ny1//2, ix0 + nx1//2]
+        pad_width[0:2] = [int((nz1 - nbz + ((nz1 - nbz) % 2)) / 2), int((nz1 - nbz + 1) / 2 - ((nz1 - nbz) % 2))]
 
     elif fft_option == 'pad_asym_Z_crop_asym_YX':
         # pad rocking angle and crop detector without centering the Bragg peak
         ny1, nx1 = smaller_primes((nby, nbx), maxprime=7, required_dividers=(2,))
         nz1 = higher_primes(nbz, maxprime=7, required_dividers=(2,))
-
-        data = data[:, nby//2 - ny1//2:nby//2 + ny1//2, nbx//2 - nx1//2:nbx//2 + nx1//2]
-        mask = mask[:, nby//2 - ny1//2:nby//2 + ny1//2, nbx//2 - nx1//2:nbx//2 + nx1//2]
-        pad_width = np.array([int((nz1 - nbz + ((nz1 - nbz) % 2)) / 2), int((nz1 - nbz + 1) / 2 - ((nz1 - nbz) % 2)),
-                              0, 0, 0, 0], dtype=int)
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qx = qx0 + np.arange(nz1)*dqx
-            qy = qy[nbx//2 - nx1//2:nbx//2 + nx1//2]
-            qz = qz[nby//2 - ny1//2:nby//2 + ny1//2]
+        start[1:] = [nby//2 - ny1//2, nbx//2 - nx1//2]
+        stop[1:] = [nby//2 + ny1//2, nbx//2 + nx1//2]
+        pad_width[0:2] = [int((nz1 - nbz + ((nz1 - nbz) % 2)) / 2), int((nz1 - nbz + 1) / 2 - ((nz1 - nbz) % 2))]
 
     elif fft_option == 'pad_sym_Z':
         # pad rocking angle based on 'pad_size'(Bragg peak centered) and keep detector size
@@ -527,41 +511,13 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
         print("pad_size for 1st axis before binning: ", pad_size[0])
         if pad_size[0] != higher_primes(pad_size[0], maxprime=7, required_dividers=(2,)):
             raise ValueError(pad_size[0], 'does not meet FFT requirements')
-
-        pad_width = np.array([int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)),
-                              int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz)),
-                              0, 0, 0, 0], dtype=int)
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qx = qx0 + np.arange(pad_size[0])*dqx
+        pad_width[0:2] = [int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)),
+                          int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz))]
 
     elif fft_option == 'pad_asym_Z':
         # pad rocking angle without centering the Bragg peak, keep detector size
         nz1 = higher_primes(nbz, maxprime=7, required_dividers=(2,))
-
-        pad_width = np.array([int((nz1-nbz+((nz1-nbz) % 2))/2), int((nz1-nbz+1)/2-((nz1-nbz) % 2)),
-                              0, 0, 0, 0], dtype=int)
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qx = qx0 + np.arange(nz1)*dqx
+        pad_width[0:2] = [int((nz1-nbz+((nz1-nbz) % 2))/2), int((nz1-nbz+1)/2-((nz1-nbz) % 2))]
 
     elif fft_option == 'pad_sym_ZYX':
         # pad both dimensions based on 'pad_size' (Bragg peak centered)
@@ -579,57 +535,20 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
         pad_width = [int(min(pad_size[0]/2-iz0, pad_size[0]-nbz)), int(min(pad_size[0]/2-nbz + iz0, pad_size[0]-nbz)),
                      int(min(pad_size[1]/2-iy0, pad_size[1]-nby)), int(min(pad_size[1]/2-nby + iy0, pad_size[1]-nby)),
                      int(min(pad_size[2]/2-ix0, pad_size[2]-nbx)), int(min(pad_size[2]/2-nbx + ix0, pad_size[2]-nbx))]
-        pad_width = np.array(list((map(lambda value: max(value, 0), pad_width))), dtype=int)  # remove negative numbers
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-        print("FFT box (qx, qz, qy): ", data.shape)
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            dqy = qy[1] - qy[0]
-            dqz = qz[1] - qz[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qy0 = qy[0] - pad_width[2] * dqy
-            qz0 = qz[0] - pad_width[1] * dqz
-            qx = qx0 + np.arange(pad_size[0]) * dqx
-            qy = qy0 + np.arange(pad_size[2]) * dqy
-            qz = qz0 + np.arange(pad_size[1]) * dqz
+        pad_width = np.clip(pad_width, 0, None).astype(int)  # remove negative numbers
 
     elif fft_option == 'pad_asym_ZYX':
         # pad both dimensions without centering the Bragg peak
         nz1, ny1, nx1 = [higher_primes(nbz, maxprime=7, required_dividers=(2,)),
                          higher_primes(nby, maxprime=7, required_dividers=(2,)),
                          higher_primes(nbx, maxprime=7, required_dividers=(2,))]
-
         pad_width = np.array(
             [int((nz1-nbz+((nz1-nbz) % 2))/2), int((nz1-nbz+1)/2-((nz1-nbz) % 2)),
-             int((ny1-nby+((pad_size[1]-nby) % 2))/2), int((ny1-nby+1)/2-((ny1-nby) % 2)),
+             int((ny1-nby+((ny1-nby) % 2))/2), int((ny1-nby+1)/2-((ny1-nby) % 2)),
              int((nx1-nbx+((nx1-nbx) % 2))/2), int((nx1-nbx+1)/2-((nx1-nbx) % 2))])
-        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
-        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
-
-        temp_frames = -1 * np.ones(data.shape[0])
-        temp_frames[pad_width[0]:pad_width[0] + nbz] = frames_logical
-        frames_logical = temp_frames
-
-        if len(q_values) != 0:
-            dqx = qx[1] - qx[0]
-            dqy = qy[1] - qy[0]
-            dqz = qz[1] - qz[0]
-            qx0 = qx[0] - pad_width[0] * dqx
-            qy0 = qy[0] - pad_width[2] * dqy
-            qz0 = qz[0] - pad_width[1] * dqz
-            qx = qx0 + np.arange(nz1) * dqx
-            qy = qy0 + np.arange(nx1) * dqy
-            qz = qz0 + np.arange(ny1) * dqz
 
     elif fft_option == 'do_nothing':
         # keep the full dataset or use 'fix_size' parameter
-        pad_width = np.zeros(6, dtype=int)  # do nothing or crop the data, starting_frame should be 0
         if len(fix_size) == 6:
             # take binning into account
             print("fix_size defined by user on the full detector: ", z0, y0, x0)
@@ -639,32 +558,42 @@ def center_fft(data, mask, detector, frames_logical, centering='max', fft_option
             fix_size[5] = fix_size[5] / detector.binning[2]
             print("fix_size defined after considering binning in detector plane (no ROI): ", z0, y0, x0)
             # size of output array defined
-            nbz, nby, nbx = np.shape(data)
             z_pan = fix_size[1] - fix_size[0]
             y_pan = fix_size[3] - fix_size[2]
             x_pan = fix_size[5] - fix_size[4]
             if z_pan > nbz or y_pan > nby or x_pan > nbx or fix_size[1] > nbz or fix_size[3] > nby or fix_size[5] > nbx:
                 raise ValueError("Predefined fix_size uncorrect")
-            else:
-                data = data[fix_size[0]:fix_size[1], fix_size[2]:fix_size[3], fix_size[4]:fix_size[5]]
-                mask = mask[fix_size[0]:fix_size[1], fix_size[2]:fix_size[3], fix_size[4]:fix_size[5]]
-
-                if fix_size[0] > 0:  # if 0, the first frame is used
-                    frames_logical[0:fix_size[0]] = 0
-                if fix_size[1] < nbz:  # if nbz, the last frame is used
-                    frames_logical[fix_size[1]:] = 0
-
-                if len(q_values) != 0:
-                    qx = qx[fix_size[0]:fix_size[1]]
-                    qy = qy[fix_size[4]:fix_size[5]]
-                    qz = qz[fix_size[2]:fix_size[3]]
+            start = [fix_size[0], fix_size[2], fix_size[4]]
+            stop = [fix_size[1], fix_size[3], fix_size[5]]
     else:
         raise ValueError("Incorrect value for 'fft_option'")
 
+    # crop the original arrays (views, no copy) and pad the result, zero_pad copies each view only once
+    data = data[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+    mask = mask[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+    if pad_width.any():
+        data = zero_pad(data, padding_width=pad_width, mask_flag=False)
+        mask = zero_pad(mask, padding_width=pad_width, mask_flag=True)  # mask padded pixels
+    print("FFT box (qx, qz, qy): ", data.shape)
+
+    # update frames_logical, frames removed by cropping are set to 0 and padded frames to -1
+    frames_logical[0:start[0]] = 0
+    frames_logical[stop[0]:] = 0
+    if pad_width[0] != 0 or pad_width[1] != 0:
+        temp_frames = -1 * np.ones(data.shape[0])
+        temp_frames[pad_width[0]:pad_width[0] + stop[0] - start[0]] = frames_logical[start[0]:stop[0]]
+        frames_logical = temp_frames
+
+    # update q values, listed in the same order as the array axes
     if len(q_values) != 0:
-        q_values[0] = qx
-        q_values[1] = qz
-        q_values[2] = qy
+        q_axes = [qx, qz, qy]
+        for axis in range(3):
+            q_axes[axis] = q_axes[axis][start[axis]:stop[axis]]
+            if pad_width[2*axis] != 0 or pad_width[2*axis+1] != 0:
+                dq = q_axes[axis][1] - q_axes[axis][0]
+                q0 = q_axes[axis][0] - pad_width[2*axis] * dq
+                q_axes[axis] = np.linspace(q0, q0 + (data.shape[axis] - 1) * dq, num=data.shape[axis])
+        q_values[0], q_values[1], q_values[2] = q_axes  # qx, qz, qy
     return data, mask, pad_width, q_values, frames_logical
 
 
@@ -726,10 +655,23 @@ def check_pixels(data, mask, debugging=False):
         raise ValueError('Data and mask must have the same shape\n data slice is ',
                          data[0, :, :].shape, ' while mask is ', mask.shape)
 
-    meandata = data.mean(axis=0)  # 2D
-    vardata = 1 / data.var(axis=0)  # 2D
-    var_mean = vardata[vardata != np.inf].mean()
-    vardata[meandata == 0] = var_mean  # pixels were data=0 (hence 1/variance=inf) are set to the mean of 1/var
+    # mean and variance from a single pass over the data, var = E[d^2] - E[d]^2 with d the data shifted by the first
+    # frame. This avoids cancellation errors, and pixels constant along the scan (e.g. detector gaps filled with the
+    # flatfield value) get exactly d = 0, hence a variance of 0 whatever the number of frames.
+    reference = data[0, :, :].astype(np.float64)
+    sum_shifted = np.zeros((nby, nbx))
+    sum_squares = np.zeros((nby, nbx))
+    for idz in range(0, nbz, 64):  # slabs of frames, to limit the size of the temporary shifted array
+        shifted = data[idz:idz + 64, :, :] - reference
+        sum_shifted += shifted.sum(axis=0)
+        sum_squares += np.einsum('ijk,ijk->jk', shifted, shifted)
+    meandata = reference + sum_shifted / nbz  # 2D, exactly 0 for pixels without intensity
+    variance = sum_squares / nbz - (sum_shifted / nbz) ** 2  # 2D
+    with np.errstate(divide='ignore'):
+        vardata = 1 / variance  # 2D
+    finite_var = np.isfinite(vardata)
+    var_mean = np.sum(vardata, where=finite_var) / np.count_nonzero(finite_var)
+    np.copyto(vardata, var_mean, where=meandata == 0)  # pixels where data=0 (1/var=inf) are set to the mean of 1/var
     # we do not want to mask pixels where there was trully no intensity during the scan
     if debugging:
         gu.combined_plots(tuple_array=(meandata, vardata), tuple_sum_frames=(False, False), tuple_sum_axis=(0, 0),
@@ -743,18 +685,12 @@ def check_pixels(data, mask, debugging=False):
     mean_threshold = min_count / nbz
     var_threshold = ((nbz - 1) * mean_threshold ** 2 + (min_count - mean_threshold) ** 2) * 1 / nbz
 
-    temp_mask = np.zeros((nby, nbx))
-    temp_mask[vardata == np.inf] = 1  # this includes hotpixels since zero intensity pixels were set to var_mean
-
-    vardata[vardata == np.inf] = 0
-    indices_badpixels = np.nonzero(vardata > 1 / var_threshold)
-    mask[indices_badpixels] = 1  # mask is 2D
-    mask[np.nonzero(temp_mask)] = 1  # update mask
+    infinite_var = np.isinf(vardata)  # this includes hotpixels since zero intensity pixels were set to var_mean
+    np.copyto(vardata, 0, where=infinite_var)
+    np.putmask(mask, (vardata > 1 / var_threshold) | infinite_var, 1)  # mask is 2D
 
     indices_badpixels = np.nonzero(mask)  # update indices
-    for index in range(nbz):
-        tempdata = data[index, :, :]
-        tempdata[indices_badpixels] = 0  # numpy array is mutable hence data will be modified
+    data[:, indices_badpixels[0], indices_badpixels[1]] = 0  # broadcast over all frames
 
     if debugging:
         meandata = data.mean(axis=0)
@@ -810,6 +746,46 @@ def create_logfile(setup, detector, scan_number, root_folder, filename):
     return logfile
 
 
+@lru_cache(maxsize=8)
+def detector_gaps(detector_name, shape):
+    """
+    Generate the boolean template of the gaps and dead pixels of a detector. Results are cached, the returned array is
+    read-only.
+
+    :param detector_name: name of the detector, 'Eiger2M', 'Eiger4M' or 'Maxipix'
+    :param shape: shape of the 2D detector frame
+    :return: a 2D boolean array of shape shape, True for pixels to be masked
+    """
+    gaps = np.zeros(shape, dtype=bool)
+    if detector_name == 'Eiger2M':
+        gaps[:, 255: 259] = True
+        gaps[:, 513: 517] = True
+        gaps[:, 771: 775] = True
+        gaps[0: 257, 72: 80] = True
+        gaps[255: 259, :] = True
+        gaps[511: 552, :] = True
+        gaps[804: 809, :] = True
+        gaps[1061: 1102, :] = True
+        gaps[1355: 1359, :] = True
+        gaps[1611: 1652, :] = True
+        gaps[1905: 1909, :] = True
+        gaps[1248:1290, 478] = True
+        gaps[1214:1298, 481] = True
+        gaps[1649:1910, 620:628] = True
+    elif detector_name == 'Eiger4M':
+        gaps[:, 1030:1040] = True
+        gaps[514:551, :] = True
+        gaps[1065:1102, :] = True
+        gaps[1616:1653, :] = True
+    elif detector_name == 'Maxipix':
+        gaps[:, 255:261] = True
+        gaps[255:261, :] = True
+    else:
+        raise ValueError('Detector ', detector_name, 'not supported')
+    gaps.flags.writeable = False  # the cached array is shared between calls
+    return gaps
+
+
 def ewald_curvature_saxs(cdi_angle, detector, setup, anticlockwise=True):
     """
     Correct the data for the curvature of Ewald sphere. Based on the CXI detector geometry convention:
@@ -920,23 +896,21 @@ def grid_bcdi(logfile, scan_number, detector, setup, flatfield=None, hotpixels=N
     :param normalize: set to True to normalize the diffracted intensity by the incident X-ray beam intensity
     :param debugging: set to True to see plots
     :param kwargs:
-     - follow_bragg (bool): True when for energy scans the detector was also scanned to follow the Bragg peak
+     - follow_bragg (bool): True when for energy scans the detector was also scanned to follow the Bragg peak.
+       Required for energy scans, defaults to False otherwise.
     :return:
      - the 3D data array (in an orthonormal frame or in the detector frame) and the 3D mask array
      - frames_logical: array of initial length the number of measured frames. In case of padding the length changes.
        A frame whose index is set to 1 means that it is used, 0 means not used, -1 means padded (added) frame.
      - the monitor values for normalization
     """
-    for k in kwargs.keys():
-        if k in ['follow_bragg']:
-            follow_bragg = kwargs['follow_bragg']
-        else:
-            raise Exception("unknown keyword argument given: allowed is 'follow_bragg'")
-    if setup.rocking_angle == 'energy':
-        try:
-            follow_bragg
-        except NameError:
-            raise TypeError("Parameter 'follow_bragg' not provided, defaulting to False")
+    follow_bragg = kwargs.pop('follow_bragg', None)
+    if kwargs:
+        raise TypeError("unknown keyword argument given: allowed is 'follow_bragg'")
+    if follow_bragg is None:
+        if setup.rocking_angle == 'energy':
+            raise TypeError("Parameter 'follow_bragg' not provided")
+        follow_bragg = False
     rawdata, rawmask, monitor, frames_logical = load_data(logfile=logfile, scan_number=scan_number, detector=detector,
                                                           setup=setup, flatfield=flatfield, hotpixels=hotpixels,
                                                           debugging=debugging)
@@ -980,33 +954,34 @@ def grid_bcdi(logfile, scan_number, detector, setup, flatfield=None, hotpixels=N
         if setup.beamline == 'ID01':
             # below is specific to ID01 energy scans where frames are duplicated for undulator gap change
             if setup.rocking_angle == 'energy':  # frames need to be removed
-                tempdata = np.zeros(((frames_logical != 0).sum(), nby, nbx))
-                offset_frame = 0
-                for idx in range(nbz):
-                    if frames_logical[idx] != 0:  # use frame
-                        tempdata[idx-offset_frame, :, :] = rawdata[idx, :, :]
-                    else:  # average with the precedent frame
-                        offset_frame = offset_frame + 1
-                        tempdata[idx-offset_frame, :, :] = (tempdata[idx-offset_frame, :, :] + rawdata[idx, :, :])/2
-                rawdata = tempdata
+                # average duplicated frames (frames_logical=0) with the precedent used frame
+                starts = np.flatnonzero(frames_logical != 0)  # index of the first frame of each group
+                nb_averaged = np.diff(np.append(starts, nbz))  # number of frames in each group
+                rawdata = np.add.reduceat(rawdata, starts, axis=0) / nb_averaged[:, np.newaxis, np.newaxis]
                 rawmask = rawmask[0:rawdata.shape[0], :, :]  # truncate the mask to have the correct size
 
         gridder = xu.Gridder3D(nbz, nby, nbx)
+        # the grid range is the same for the mask and the data, calculate it only once
+        gridder.dataRange(qx.min(), qx.max(), qz.min(), qz.max(), qy.min(), qy.max(), fixed=True)
         # convert mask to rectangular grid in reciprocal space
-        gridder(qx, qz, qy, rawmask)
-        mask = np.copy(gridder.data)
+        if rawmask.any():
+            gridder(qx, qz, qy, rawmask)
+            mask = gridder.data  # gridder.data is already a copy of the gridded array
+        else:  # nothing to interpolate, the gridded mask is also empty
+            mask = np.zeros((nbz, nby, nbx))
         # convert data to rectangular grid in reciprocal space
         gridder(qx, qz, qy, rawdata)  # qx downstream, qz vertical up, qy outboard
+        data = gridder.data
 
         q_values = [gridder.xaxis, gridder.yaxis, gridder.zaxis]  # qx downstream, qz vertical up, qy outboard
-        fig, _, _ = gu.contour_slices(gridder.data, (gridder.xaxis, gridder.yaxis, gridder.zaxis), sum_frames=False,
+        fig, _, _ = gu.contour_slices(data, (gridder.xaxis, gridder.yaxis, gridder.zaxis), sum_frames=False,
                                       title='Regridded data',
-                                      levels=np.linspace(0, int(np.log10(gridder.data.max())), 150, endpoint=False),
+                                      levels=np.linspace(0, int(np.log10(data.max())), 150, endpoint=False),
                                       plot_colorbar=True, scale='log', is_orthogonal=True, reciprocal_space=True)
         fig.savefig(detector.savedir + 'reciprocal_space_' + str(nbz) + '_' + str(nby) + '_' + str(nbx) + '_' + '.png')
         plt.close(fig)
 
-        return q_values, rawdata, gridder.data, rawmask, mask, frames_logical, monitor
+        return q_values, rawdata, data, rawmask, mask, frames_logical, monitor
 
 
 def gridmap(logfile, scan_number, detector, setup, flatfield=None, hotpixels=None, orthogonalize=False, hxrd=None,
@@ -1025,23 +1000,21 @@ def gridmap(logfile, scan_number, detector, setup, flatfield=None, hotpixels=Non
     :param normalize: set to True to normalize the diffracted intensity by the incident X-ray beam intensity
     :param debugging: set to True to see plots
     :param kwargs:
-     - follow_bragg (bool): True when for energy scans the detector was also scanned to follow the Bragg peak
+     - follow_bragg (bool): True when for energy scans the detector was also scanned to follow the Bragg peak.
+       Required for energy scans, defaults to False otherwise.
     :return:
      - the 3D data array (in an orthonormal frame or in the detector frame) and the 3D mask array
      - frames_logical: array of initial length the number of measured frames. In case of padding the length changes.
        A frame whose index is set to 1 means that it is used, 0 means not used, -1 means padded (added) frame.
      - the monitor values for normalization
     """
-    for k in kwargs.keys():
-        if k in ['follow_bragg']:
-            follow_bragg = kwargs['follow_bragg']
-        else:
-            raise Exception("unknown keyword argument given: allowed is 'follow_bragg'")
-    if setup.rocking_angle == 'energy':
-        try:
-            follow_bragg
-        except NameError:
-            raise TypeError("Parameter 'follow_bragg' not provided, defaulting to False")
+    follow_bragg = kwargs.pop('follow_bragg', None)
+    if kwargs:
+        raise TypeError("unknown keyword argument given: allowed is 'follow_bragg'")
+    if follow_bragg is None:
+        if setup.rocking_angle == 'energy':
+            raise TypeError("Parameter 'follow_bragg' not provided")
+        follow_bragg = False
     rawdata, rawmask, monitor, frames_logical = load_data(logfile=logfile, scan_number=scan_number, detector=detector,
                                                           setup=setup, flatfield=flatfield, hotpixels=hotpixels,
                                                           debugging=debugging)
@@ -1090,33 +1063,34 @@ def gridmap(logfile, scan_number, detector, setup, flatfield=None, hotpixels=Non
         if setup.beamline == 'ID01':
             # below is specific to ID01 energy scans where frames are duplicated for undulator gap change
             if setup.rocking_angle == 'energy':  # frames need to be removed
-                tempdata = np.zeros(((frames_logical != 0).sum(), nby, nbx))
-                offset_frame = 0
-                for idx in range(nbz):
-                    if frames_logical[idx] != 0:  # use frame
-                        tempdata[idx-offset_frame, :, :] = rawdata[idx, :, :]
-                    else:  # average with the precedent frame
-                        offset_frame = offset_frame + 1
-                        tempdata[idx-offset_frame, :, :] = (tempdata[idx-offset_frame, :, :] + rawdata[idx, :, :])/2
-                rawdata = tempdata
+                # average duplicated frames (frames_logical=0) with the precedent used frame
+                starts = np.flatnonzero(frames_logical != 0)  # index of the first frame of each group
+                nb_averaged = np.diff(np.append(starts, nbz))  # number of frames in each group
+                rawdata = np.add.reduceat(rawdata, starts, axis=0) / nb_averaged[:, np.newaxis, np.newaxis]
                 rawmask = rawmask[0:rawdata.shape[0], :, :]  # truncate the mask to have the correct size
                 nbz = rawdata.shape[0]
         gridder = xu.Gridder3D(nbz, nby, nbx)
+        # the grid range is the same for the mask and the data, calculate it only once
+        gridder.dataRange(qx.min(), qx.max(), qz.min(), qz.max(), qy.min(), qy.max(), fixed=True)
         # convert mask to rectangular grid in reciprocal space
-        gridder(qx, qz, qy, rawmask)  # qx downstream, qz vertical up, qy outboard
-        mask = np.copy(gridder.data)
+        if rawmask.any():
+            gridder(qx, qz, qy, rawmask)  # qx downstream, qz vertical up, qy outboard
+            mask = gridder.data  # gridder.data is already a copy of the gridded array
+        else:  # nothing to interpolate, the gridded mask is also empty
+            mask = np.zeros((nbz, nby, nbx))
         # convert data to rectangular grid in reciprocal space
         gridder(qx, qz, qy, rawdata)  # qx downstream, qz vertical up, qy outboard
+        data = gridder.data
 
         q_values = [gridder.xaxis, gridder.yaxis, gridder.zaxis]  # downstream, vertical up, outboard
-        fig, _, _ = gu.contour_slices(gridder.data, (gridder.xaxis, gridder.yaxis, gridder.zaxis), sum_frames=False,
+        fig, _, _ = gu.contour_slices(data, (gridder.xaxis, gridder.yaxis, gridder.zaxis), sum_frames=False,
                                       title='Regridded data',
-                                      levels=np.linspace(0, int(np.log10(gridder.data.max())), 150, endpoint=False),
+                                      levels=np.linspace(0, int(np.log10(data.max())), 150, endpoint=False),
                                       plot_colorbar=True, scale='log', is_orthogonal=True, reciprocal_space=True)
         fig.savefig(detector.savedir + 'reciprocal_space_' + str(nbz) + '_' + str(nby) + '_' + str(nbx) + '_' + '.png')
         plt.close(fig)
 
-        return q_values, rawdata, gridder.data, rawmask, mask, frames_logical, monitor
+        return q_values, rawdata, data, rawmask, mask, frames_logical, monitor
 
 
 def higher_primes(number, maxprime=13, required_dividers=(4,)):
@@ -1131,26 +1105,29 @@ def higher_primes(number, maxprime=13, required_dividers=(4,)):
     :return: the integer (or list/array of integers) fulfilling the requirements
     """
     if (type(number) is list) or (type(number) is tuple) or (type(number) is np.ndarray):
-        vn = []
-        for i in number:
-            limit = i
-            assert (i > 1 and maxprime <= i)
-            while try_smaller_primes(i, maxprime=maxprime, required_dividers=required_dividers) is False:
-                i = i + 1
-                if i == limit:
-                    return limit
-            vn.append(i)
+        numbers = np.asarray(number)
+        assert (numbers.min() > 1 and maxprime <= numbers.min())
+        lcm = 1 if required_dividers is None else int(np.lcm.reduce(required_dividers))
+        if not try_smaller_primes(lcm, maxprime=maxprime, required_dividers=None):
+            raise ValueError('required_dividers ', required_dividers, ' are not compatible with maxprime=', maxprime)
+        limit = 1 << (2 * max(int(numbers.max()), lcm) - 1).bit_length()  # power of 2 to share cached tables
+        candidates = smooth_numbers(maxprime=maxprime, limit=limit)
+        candidates = candidates[candidates % lcm == 0]
+        # index of the smallest candidate >= number, for all numbers at once
+        indices = np.searchsorted(candidates, numbers, side='left')
         if type(number) is np.ndarray:
-            return np.array(vn)
-        return vn
+            return candidates[indices]
+        return [int(val) for val in candidates[indices]]
     else:
-        limit = number
         assert (number > 1 and maxprime <= number)
-        while try_smaller_primes(number, maxprime=maxprime, required_dividers=required_dividers) is False:
-            number = number + 1
-            if number == limit:
-                return limit
-        return number
+        lcm = 1 if required_dividers is None else int(np.lcm.reduce(required_dividers))
+        if not try_smaller_primes(lcm, maxprime=maxprime, required_dividers=None):
+            raise ValueError('required_dividers ', required_dividers, ' are not compatible with maxprime=', maxprime)
+        # a multiple of lcm by a power of 2 always exists in [number, 2*max(number, lcm)]
+        limit = 1 << (2 * max(int(number), lcm) - 1).bit_length()  # power of 2 to share cached tables
+        candidates = smooth_numbers(maxprime=maxprime, limit=limit)
+        candidates = candidates[(candidates >= number) & (candidates % lcm == 0)]
+        return int(candidates[0])
 
 
 def init_qconversion(setup):
@@ -1200,13 +1177,16 @@ def load_background(background_file):
     """
     Load a background file.
 
-    :param background_file: the path of the background file
+    :param background_file: the path of the background file (.npz or .npy)
     :return: a 2D background
     """
     if background_file != "":
-        background = np.load(background_file)
-        npz_key = background.files
-        background = background[npz_key[0]]
+        if os.path.splitext(background_file)[1] == '.npy':  # memory-mapped, the array is only read
+            background = np.load(background_file, mmap_mode='r')
+        else:  # npz archive, the first array is decompressed once
+            background = np.load(background_file)
+            npz_key = background.files
+            background = background[npz_key[0]]
         if background.ndim != 2:
             raise ValueError('background should be a 2D array')
     else:
@@ -1297,44 +1277,39 @@ def load_cristal_data(logfile, detector, flatfield, hotpixels, background, debug
 
     :param logfile: h5py File object of CRISTAL .nxs scan file
     :param detector: the detector object: Class experiment_utils.Detector()
-    :param flatfield: the 2D flatfield array
-    :param hotpixels: the 2D hotpixels array
-    :param background: the 2D background array to subtract to the data
+    :param flatfield: the 2D flatfield array, None to skip the flatfield correction
+    :param hotpixels: the 2D hotpixels array, None if there is no hotpixel to mask
+    :param background: the 2D background array to subtract to the data, None to skip the subtraction
     :param debugging: set to True to see plots
     :return:
      - the 3D data array in the detector frame and the 3D mask array
      - a logical array of length = initial frames number. A frame used will be set to True, a frame unused to False.
      - the monitor values for normalization
     """
-    mask_2d = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
+    scan_group = logfile[list(logfile.keys())[0]]  # the scan group is resolved once, subgroups are relative to it
+    # read only the ROI of all frames, directly into a preallocated array
+    dataset = scan_group['scan_data/data_06']
+    nb_img = dataset.shape[0]
+    tmp_data = np.empty((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]),
+                        dtype=dataset.dtype)
+    dataset.read_direct(tmp_data,
+                        source_sel=np.s_[:, detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]])
 
-    group_key = list(logfile.keys())[0]
-    tmp_data = logfile['/' + group_key + '/scan_data/data_06'][:]
+    if detector.name != "Maxipix":
+        raise ValueError('Detector ', detector.name, 'not supported for CRISTAL')
+    mask_2d, masked_values, flatfield, background = mask_detector_roi(detector=detector, flatfield=flatfield,
+                                                                      hotpixels=hotpixels, background=background)
 
-    nb_img = tmp_data.shape[0]
-    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]))
-
-    for idx in range(nb_img):
-        ccdraw = tmp_data[idx, :, :]
-        ccdraw = ccdraw - background
-        ccdraw, mask_2d = remove_hotpixels(data=ccdraw, mask=mask_2d, hotpixels=hotpixels)
-        if detector.name == "Maxipix":
-            ccdraw, mask_2d = mask_maxipix(ccdraw, mask_2d)
-        else:
-            raise ValueError('Detector ', detector.name, 'not supported for CRISTAL')
-        ccdraw = flatfield * ccdraw
-        ccdraw = ccdraw[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
-        data[idx, :, :] = ccdraw
+    # subtract the background and apply the flatfield correction to all frames at once
+    data = _correct_frames(frames=tmp_data, flatfield=flatfield, background=background, mask_2d=mask_2d,
+                           masked_values=masked_values)
 
-    mask_2d = mask_2d[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
     data, mask_2d = check_pixels(data=data, mask=mask_2d, debugging=debugging)
-    mask3d = np.repeat(mask_2d[np.newaxis, :, :], nb_img, axis=0)
-    mask3d[np.isnan(data)] = 1
-    data[np.isnan(data)] = 0
+    data, mask3d = _build_mask3d(data=data, mask_2d=mask_2d)
 
     frames_logical = np.ones(nb_img)
 
-    monitor = logfile['/' + group_key + '/scan_data/data_04'][:]
+    monitor = scan_group['scan_data/data_04'][:]
 
     return data, mask3d, monitor, frames_logical
 
@@ -1346,38 +1321,25 @@ def load_custom_data(custom_images, custom_monitor, detector, flatfield, hotpixe
     :param custom_images: the list of image numbers
     :param custom_monitor: list of monitor values for normalization
     :param detector: the detector object: Class experiment_utils.Detector()
-    :param flatfield: the 2D flatfield array
-    :param hotpixels: the 2D hotpixels array
-    :param background: the 2D background array to subtract to the data
+    :param flatfield: the 2D flatfield array, None to skip the flatfield correction
+    :param hotpixels: the 2D hotpixels array, None if there is no hotpixel to mask
+    :param background: the 2D background array to subtract to the data, None to skip the subtraction
     :param debugging: set to True to see plots
     :return:
     """
-    mask_2d = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
     nb_img = len(custom_images)
-    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]))
     ccdfiletmp = os.path.join(detector.datadir, detector.template_imagefile)
 
-    for idx in range(nb_img):
-        i = int(custom_images[idx])
-        e = fabio.open(ccdfiletmp % i)
-        ccdraw = e.data
-        ccdraw = ccdraw - background
-        ccdraw, mask_2d = remove_hotpixels(data=ccdraw, mask=mask_2d, hotpixels=hotpixels)
-        if detector.name == "Eiger2M":
-            ccdraw, mask_2d = mask_eiger(data=ccdraw, mask=mask_2d)
-        elif detector.name == "Maxipix":
-            ccdraw, mask_2d = mask_maxipix(data=ccdraw, mask=mask_2d)
-        else:
-            raise ValueError('Detector ', detector.name, 'not supported for ID01')
-        ccdraw = flatfield * ccdraw
-        ccdraw = ccdraw[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
-        data[idx, :, :] = ccdraw
+    if detector.name != "Eiger2M" and detector.name != "Maxipix":
+        raise ValueError('Detector ', detector.name, 'not supported for ID01')
+    mask_2d, masked_values, flatfield, background = mask_detector_roi(detector=detector, flatfield=flatfield,
+                                                                      hotpixels=hotpixels, background=background)
 
-    mask_2d = mask_2d[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
+    file_list = [ccdfiletmp % int(custom_images[idx]) for idx in range(nb_img)]
+    data = _read_fabio_frames(file_list=file_list, detector=detector, flatfield=flatfield, background=background,
+                              mask_2d=mask_2d, masked_values=masked_values)
     data, mask_2d = check_pixels(data=data, mask=mask_2d, debugging=debugging)
-    mask3d = np.repeat(mask_2d[np.newaxis, :, :], nb_img, axis=0)
-    mask3d[np.isnan(data)] = 1
-    data[np.isnan(data)] = 0
+    data, mask3d = _build_mask3d(data=data, mask_2d=mask_2d)
 
     frames_logical = np.ones(nb_img)
 
@@ -1402,13 +1364,6 @@ def load_data(logfile, scan_number, detector, setup, flatfield=None, hotpixels=N
      - frames_logical: array of initial length the number of measured frames. In case of padding the length changes.
        A frame whose index is set to 1 means that it is used, 0 means not used, -1 means padded (added) frame.
     """
-    if flatfield is None:
-        flatfield = np.ones((detector.nb_pixel_y, detector.nb_pixel_x))
-    if hotpixels is None:
-        hotpixels = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
-    if background is None:
-        background = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
-
     print('Detector size defined by the ROI:', detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2])
     print('Detector physical size:', detector.nb_pixel_y, detector.nb_pixel_x)
     if detector.roi[1]-detector.roi[0] > detector.nb_pixel_y or detector.roi[3]-detector.roi[2] > detector.nb_pixel_x:
@@ -1444,21 +1399,11 @@ def load_data(logfile, scan_number, detector, setup, flatfield=None, hotpixels=N
     else:
         raise ValueError('Wrong value for "beamline" parameter')
 
-    # remove indices where frames_logical=0
-    nbz, nby, nbx = data.shape
-    nb_frames = (frames_logical != 0).sum()
-
-    newdata = np.zeros((nb_frames, nby, nbx))
-    newmask = np.zeros((nb_frames, nby, nbx))
+    # remove indices where frames_logical=0, keeping the dtype of the loaded arrays
     # do not process the monitor here, it is done in normalize_dataset()
-
-    nb_overlap = 0
-    for idx in range(len(frames_logical)):
-        if frames_logical[idx]:
-            newdata[idx - nb_overlap, :, :] = data[idx, :, :]
-            newmask[idx - nb_overlap, :, :] = mask3d[idx, :, :]
-        else:
-            nb_overlap = nb_overlap + 1
+    frames_used = np.nonzero(frames_logical)[0]
+    newdata = data[frames_used, :, :]
+    newmask = mask3d[frames_used, :, :]
 
     return newdata, newmask, monitor, frames_logical
 
@@ -1497,13 +1442,16 @@ def load_flatfield(flatfield_file):
     """
     Load a flatfield file.
 
-    :param flatfield_file: the path of the flatfield file
+    :param flatfield_file: the path of the flatfield file (.npz or .npy)
     :return: a 2D flatfield
     """
     if flatfield_file != "":
-        flatfield = np.load(flatfield_file)
-        npz_key = flatfield.files
-        flatfield = flatfield[npz_key[0]]
+        if os.path.splitext(flatfield_file)[1] == '.npy':  # memory-mapped, the array is only read
+            flatfield = np.load(flatfield_file, mmap_mode='r')
+        else:  # npz archive, the first array is decompressed once
+            flatfield = np.load(flatfield_file)
+            npz_key = flatfield.files
+            flatfield = flatfield[npz_key[0]]
         if flatfield.ndim != 2:
             raise ValueError('flatfield should be a 2D array')
     else:
@@ -1515,18 +1463,21 @@ def load_hotpixels(hotpixels_file):
     """
     Load a hotpixels file.
 
-    :param hotpixels_file: the path of the hotpixels file
+    :param hotpixels_file: the path of the hotpixels file (.npz or .npy)
     :return: a 2D array of hotpixels (1 for hotpixel, 0 for normal pixel)
     """
     if hotpixels_file != "":
-        hotpixels = np.load(hotpixels_file)
-        npz_key = hotpixels.files
-        hotpixels = hotpixels[npz_key[0]]
+        if os.path.splitext(hotpixels_file)[1] == '.npy':  # memory-mapped, the binary copy below is the only one
+            hotpixels = np.load(hotpixels_file, mmap_mode='r')
+        else:  # npz archive, the first array is decompressed once
+            hotpixels = np.load(hotpixels_file)
+            npz_key = hotpixels.files
+            hotpixels = hotpixels[npz_key[0]]
         if hotpixels.ndim == 3:
             hotpixels = hotpixels.sum(axis=0)
         if hotpixels.ndim != 2:
             raise ValueError('hotpixels should be a 2D array')
-        hotpixels[np.nonzero(hotpixels)] = 1
+        hotpixels = (hotpixels != 0).astype(np.uint8)
     else:
         hotpixels = None
     return hotpixels
@@ -1539,9 +1490,9 @@ def load_id01_data(logfile, scan_number, detector, flatfield, hotpixels, backgro
     :param logfile: Silx SpecFile object containing the information about the scan and image numbers
     :param scan_number: the scan number to load
     :param detector: the detector object: Class experiment_utils.Detector()
-    :param flatfield: the 2D flatfield array
-    :param hotpixels: the 2D hotpixels array
-    :param background: the 2D background array to subtract to the data
+    :param flatfield: the 2D flatfield array, None to skip the flatfield correction
+    :param hotpixels: the 2D hotpixels array, None if there is no hotpixel to mask
+    :param background: the 2D background array to subtract to the data, None to skip the subtraction
     :param debugging: set to True to see plots
     :return:
      - the 3D data array in the detector frame and the 3D mask array
@@ -1549,8 +1500,6 @@ def load_id01_data(logfile, scan_number, detector, flatfield, hotpixels, backgro
      - frames_logical: array of initial length the number of measured frames. In case of padding the length changes.
        A frame whose index is set to 1 means that it is used, 0 means not used, -1 means padded (added) frame.
     """
-    mask_2d = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
-
     labels = logfile[str(scan_number) + '.1'].labels  # motor scanned
     labels_data = logfile[str(scan_number) + '.1'].data  # motor scanned
 
@@ -1567,28 +1516,16 @@ def load_id01_data(logfile, scan_number, detector, flatfield, hotpixels, backgro
             raise ValueError(detector.counter, 'not in the list, the detector name may be wrong')
 
     nb_img = len(ccdn)
-    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]))
-    for idx in range(nb_img):
-        i = int(ccdn[idx])
-        e = fabio.open(ccdfiletmp % i)
-        ccdraw = e.data
-        ccdraw = ccdraw - background
-        ccdraw, mask_2d = remove_hotpixels(data=ccdraw, mask=mask_2d, hotpixels=hotpixels)
-        if detector.name == "Eiger2M":
-            ccdraw, mask_2d = mask_eiger(data=ccdraw, mask=mask_2d)
-        elif detector.name == "Maxipix":
-            ccdraw, mask_2d = mask_maxipix(data=ccdraw, mask=mask_2d)
-        else:
-            raise ValueError('Detector ', detector.name, 'not supported for ID01')
-        ccdraw = flatfield * ccdraw
-        ccdraw = ccdraw[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
-        data[idx, :, :] = ccdraw
-
-    mask_2d = mask_2d[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
+    if detector.name != "Eiger2M" and detector.name != "Maxipix":
+        raise ValueError('Detector ', detector.name, 'not supported for ID01')
+    mask_2d, masked_values, flatfield, background = mask_detector_roi(detector=detector, flatfield=flatfield,
+                                                                      hotpixels=hotpixels, background=background)
+
+    file_list = [ccdfiletmp % int(ccdn[idx]) for idx in range(nb_img)]
+    data = _read_fabio_frames(file_list=file_list, detector=detector, flatfield=flatfield, background=background,
+                              mask_2d=mask_2d, masked_values=masked_values)
     data, mask_2d = check_pixels(data=data, mask=mask_2d, debugging=debugging)
-    mask3d = np.repeat(mask_2d[np.newaxis, :, :], nb_img, axis=0)
-    mask3d[np.isnan(data)] = 1
-    data[np.isnan(data)] = 0
+    data, mask3d = _build_mask3d(data=data, mask_2d=mask_2d)
 
     frames_logical = np.ones(nb_img)
 
@@ -1610,9 +1547,9 @@ def load_p10_data(logfile, detector, flatfield, hotpixels, background, debugging
 
     :param logfile: path of the . fio file containing the information about the scan
     :param detector: the detector object: Class experiment_utils.Detector()
-    :param flatfield: the 2D flatfield array
-    :param hotpixels: the 2D hotpixels array
-    :param background: the 2D background array to subtract to the data
+    :param flatfield: the 2D flatfield array, None to skip the flatfield correction
+    :param hotpixels: the 2D hotpixels array, None if there is no hotpixel to mask
+    :param background: the 2D background array to subtract to the data, None to skip the subtraction
     :param debugging: set to True to see plots
     :return:
      - the 3D data array in the detector frame and the 3D mask array
@@ -1623,76 +1560,71 @@ def load_p10_data(logfile, detector, flatfield, hotpixels, background, debugging
     """
     import hdf5plugin  # should be imported before h5py
     import h5py
-    mask_2d = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
+
+    if detector.name != "Eiger4M":
+        raise ValueError('Detector ', detector.name, 'not supported for P10')
+    mask_2d, masked_values, flatfield, background = mask_detector_roi(detector=detector, flatfield=flatfield,
+                                                                      hotpixels=hotpixels, background=background)
 
     ccdfiletmp = os.path.join(detector.datadir, detector.template_imagefile)
 
     h5file = h5py.File(ccdfiletmp, 'r')
     nb_img = len(list(h5file['entry/data']))
-    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]))
+    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]), dtype=np.float32)
 
     is_series = detector.is_series
 
     for file_idx in range(nb_img):
 
-        idx = 0
-        series_data = []
         if is_series:
             data_path = 'data_' + str('{:06d}'.format(file_idx+1))
         else:
             data_path = 'data_000001'
 
-        while True:
-            try:
-                try:
-                    tmp_data = h5file['entry']['data'][data_path][idx]
-                except OSError:
-                    raise OSError('hdf5plugin is not installed')
-                tmp_data = tmp_data - background
-                ccdraw, mask2d = remove_hotpixels(data=tmp_data, mask=mask_2d, hotpixels=hotpixels)
-                if detector.name == "Eiger4M":
-                    ccdraw, mask_2d = mask_eiger4m(data=ccdraw, mask=mask_2d)
-                else:
-                    raise ValueError('Detector ', detector.name, 'not supported for P10')
-                ccdraw = flatfield * ccdraw
-                ccdraw = ccdraw[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
-                series_data.append(ccdraw)
-                idx = idx + 1
-            except ValueError:  # reached the end of the series
-                break
+        # read only the ROI of all images of the series, directly into a preallocated array
+        dataset = h5file['entry']['data'][data_path]
+        series_data = np.empty((dataset.shape[0], detector.roi[1] - detector.roi[0],
+                                detector.roi[3] - detector.roi[2]), dtype=dataset.dtype)
+        try:
+            dataset.read_direct(series_data,
+                                source_sel=np.s_[:, detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]])
+        except OSError:
+            raise OSError('hdf5plugin is not installed')
+
+        # background and flatfield corrections restricted to the ROI
+        series_data = _correct_frames(frames=series_data, flatfield=flatfield, background=background,
+                                      mask_2d=mask_2d, masked_values=masked_values)
 
         if is_series:
-            data[file_idx, :, :] = np.asarray(series_data).sum(axis=0)
+            data[file_idx, :, :] = series_data.sum(axis=0)
         else:
-            data = np.asarray(series_data)
+            data = series_data
             break
         print('Loading frame', file_idx)
 
-    mask_2d = mask_2d[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
     data, mask_2d = check_pixels(data=data, mask=mask_2d, debugging=debugging)
-    mask3d = np.repeat(mask_2d[np.newaxis, :, :], nb_img, axis=0)
-    mask3d[np.isnan(data)] = 1
-    data[np.isnan(data)] = 0
+    data, mask3d = _build_mask3d(data=data, mask_2d=mask_2d)
 
     frames_logical = np.ones(nb_img)
-    fio = open(logfile, 'r')
+    with open(logfile, 'r') as fio:
+        fio_lines = fio.readlines()
 
-    monitor = []
-    fio_lines = fio.readlines()
-    for line in fio_lines:
-        this_line = line.strip()
-        words = this_line.split()
+    # parse the header until the first data line
+    data_start = len(fio_lines)
+    for line_nb, line in enumerate(fio_lines):
+        words = line.split()
         if 'Col' in words and ('ipetra' in words or 'curpetra' in words):
             # template = ' Col 6 ipetra DOUBLE\n' (2018) or ' Col 6 curpetra DOUBLE\n' (2019)
             index_monitor = int(words[1])-1  # python index starts at 0
         try:
             float(words[0])  # if this does not fail, we are reading data
-            monitor.append(float(words[index_monitor]))
-        except ValueError:  # first word is not a number, skip this line
+            data_start = line_nb
+            break
+        except (ValueError, IndexError):  # first word is not a number or empty line, skip this line
             continue
 
-    fio.close()
-    monitor = np.asarray(monitor, dtype=float)
+    # parse all data lines at once, the end of the acquisition is commented with '!'
+    monitor = np.loadtxt(fio_lines[data_start:], usecols=index_monitor, comments='!', ndmin=1)
     return data, mask3d, monitor, frames_logical
 
 
@@ -1703,9 +1635,9 @@ def load_sixs_data(logfile, beamline, detector, flatfield, hotpixels, background
     :param logfile: nxsReady Dataset object of SIXS .nxs scan file
     :param beamline: SIXS_2019 or SIXS_2018
     :param detector: the detector object: Class experiment_utils.Detector()
-    :param flatfield: the 2D flatfield array
-    :param hotpixels: the 2D hotpixels array
-    :param background: the 2D background array to subtract to the data
+    :param flatfield: the 2D flatfield array, None to skip the flatfield correction
+    :param hotpixels: the 2D hotpixels array, None if there is no hotpixel to mask
+    :param background: the 2D background array to subtract to the data, None to skip the subtraction
     :param debugging: set to True to see plots
     :return:
      - the 3D data array in the detector frame and the 3D mask array
@@ -1729,32 +1661,58 @@ def load_sixs_data(logfile, beamline, detector, flatfield, hotpixels, background
                 tmp_data = logfile.image[:]
                 monitor = logfile.intensity[:]
 
-    mask_2d = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x))
-
     frames_logical = np.ones(tmp_data.shape[0])
     nb_img = tmp_data.shape[0]
-    data = np.zeros((nb_img, detector.roi[1] - detector.roi[0], detector.roi[3] - detector.roi[2]))
-
-    for idx in range(nb_img):
-        ccdraw = tmp_data[idx, :, :]
-        ccdraw = ccdraw - background
-        ccdraw, mask_2d = remove_hotpixels(data=ccdraw, mask=mask_2d, hotpixels=hotpixels)
-        if detector.name == "Maxipix":
-            ccdraw, mask_2d = mask_maxipix(data=ccdraw, mask=mask_2d)
-        else:
-            raise ValueError('Detector ', detector.name, 'not supported for SIXS')
-        ccdraw = flatfield * ccdraw
-        ccdraw = ccdraw[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
-        data[idx, :, :] = ccdraw
 
-    mask_2d = mask_2d[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
+    if detector.name != "Maxipix":
+        raise ValueError('Detector ', detector.name, 'not supported for SIXS')
+    mask_2d, masked_values, flatfield, background = mask_detector_roi(detector=detector, flatfield=flatfield,
+                                                                      hotpixels=hotpixels, background=background)
+
+    # crop all frames to the ROI, then subtract the background and apply the flatfield correction at once
+    data = _correct_frames(frames=tmp_data[:, detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]],
+                           flatfield=flatfield, background=background, mask_2d=mask_2d, masked_values=masked_values)
+
     data, mask_2d = check_pixels(data=data, mask=mask_2d, debugging=debugging)
-    mask3d = np.repeat(mask_2d[np.newaxis, :, :], nb_img, axis=0)
-    mask3d[np.isnan(data)] = 1
-    data[np.isnan(data)] = 0
+    data, mask3d = _build_mask3d(data=data, mask_2d=mask_2d)
     return data, mask3d, monitor, frames_logical
 
 
+def mask_detector_roi(detector, flatfield, hotpixels, background=None):
+    """
+    Compute the 2D mask of hotpixels and detector gaps restricted to the region of interest of the detector, and the
+    value taken by masked pixels in the flatfield corrected data.
+
+    :param detector: the detector object: Class experiment_utils.Detector()
+    :param flatfield: the 2D flatfield array, None to skip the flatfield correction
+    :param hotpixels: the 2D hotpixels array. 1 for a hotpixel, 0 for normal pixels.
+    :param background: the 2D background array, None to skip the background subtraction
+    :return: the 2D mask, the 2D array of masked values and the flatfield and background (None if not provided),
+     all restricted to the region of interest
+    """
+    roi = np.s_[detector.roi[0]:detector.roi[1], detector.roi[2]:detector.roi[3]]
+    # masked_values is the value taken by masked pixels before the flatfield correction (1 in Eiger4M gaps)
+    mask_2d = np.zeros((detector.nb_pixel_y, detector.nb_pixel_x), dtype=np.uint8)
+    masked_values, mask_2d = remove_hotpixels(data=np.ones((detector.nb_pixel_y, detector.nb_pixel_x)),
+                                              mask=mask_2d, hotpixels=hotpixels)
+    if detector.name == "Eiger2M":
+        masked_values, mask_2d = mask_eiger(data=masked_values, mask=mask_2d)
+    elif detector.name == "Eiger4M":
+        masked_values, mask_2d = mask_eiger4m(data=masked_values, mask=mask_2d)
+    elif detector.name == "Maxipix":
+        masked_values, mask_2d = mask_maxipix(data=masked_values, mask=mask_2d)
+    else:
+        raise ValueError('Detector ', detector.name, 'not supported')
+    mask_2d = mask_2d[roi]
+    masked_values = masked_values[roi]
+    if flatfield is not None:
+        flatfield = flatfield[roi]
+        masked_values = masked_values * flatfield
+    if background is not None:
+        background = background[roi]
+    return mask_2d, masked_values, flatfield, background
+
+
 def mask_eiger(data, mask):
     """
     Mask data measured with an Eiger2M detector
@@ -1769,35 +1727,9 @@ def mask_eiger(data, mask):
     if data.shape != mask.shape:
         raise ValueError('Data and mask must have the same shape\n data is ', data.shape, ' while mask is ', mask.shape)
 
-    data[:, 255: 259] = 0
-    data[:, 513: 517] = 0
-    data[:, 771: 775] = 0
-    data[0: 257, 72: 80] = 0
-    data[255: 259, :] = 0
-    data[511: 552, :0] = 0
-    data[804: 809, :] = 0
-    data[1061: 1102, :] = 0
-    data[1355: 1359, :] = 0
-    data[1611: 1652, :] = 0
-    data[1905: 1909, :] = 0
-    data[1248:1290, 478] = 0
-    data[1214:1298, 481] = 0
-    data[1649:1910, 620:628] = 0
-
-    mask[:, 255: 259] = 1
-    mask[:, 513: 517] = 1
-    mask[:, 771: 775] = 1
-    mask[0: 257, 72: 80] = 1
-    mask[255: 259, :] = 1
-    mask[511: 552, :] = 1
-    mask[804: 809, :] = 1
-    mask[1061: 1102, :] = 1
-    mask[1355: 1359, :] = 1
-    mask[1611: 1652, :] = 1
-    mask[1905: 1909, :] = 1
-    mask[1248:1290, 478] = 1
-    mask[1214:1298, 481] = 1
-    mask[1649:1910, 620:628] = 1
+    gaps = detector_gaps(detector_name='Eiger2M', shape=data.shape)
+    data[gaps] = 0
+    mask[gaps] = 1
     return data, mask
 
 
@@ -1815,15 +1747,9 @@ def mask_eiger4m(data, mask):
     if data.shape != mask.shape:
         raise ValueError('Data and mask must have the same shape\n data is ', data.shape, ' while mask is ', mask.shape)
 
-    data[:, 1030:1040] = 1
-    data[514:551, :] = 1
-    data[1065:1102, :] = 1
-    data[1616:1653, :] = 1
-
-    mask[:, 1030:1040] = 1
-    mask[514:551, :] = 1
-    mask[1065:1102, :] = 1
-    mask[1616:1653, :] = 1
+    gaps = detector_gaps(detector_name='Eiger4M', shape=data.shape)
+    data[gaps] = 1
+    mask[gaps] = 1
     return data, mask
 
 
@@ -1841,11 +1767,9 @@ def mask_maxipix(data, mask):
     if data.shape != mask.shape:
         raise ValueError('Data and mask must have the same shape\n data is ', data.shape, ' while mask is ', mask.shape)
 
-    data[:, 255:261] = 0
-    data[255:261, :] = 0
-
-    mask[:, 255:261] = 1
-    mask[255:261, :] = 1
+    gaps = detector_gaps(detector_name='Maxipix', shape=data.shape)
+    data[gaps] = 0
+    mask[gaps] = 1
     return data, mask
 
 
@@ -1873,21 +1797,44 @@ def mean_filter(data, nb_neighbours, mask, min_count=3, interpolate='mask_isolat
                           tuple_width_v=(None, None), tuple_width_h=(None, None), tuple_colorbar=(True, True),
                           tuple_vmin=(-1, 0), tuple_vmax=(np.nan, 1), tuple_scale=('log', 'linear'),
                           tuple_title=('Data before filtering', 'Mask before filtering'), reciprocal_space=True)
-    zero_pixels = np.argwhere(data == 0)
-    nb_pixels = 0
-    for indx in range(zero_pixels.shape[0]):
-        pixrow = zero_pixels[indx, 0]
-        pixcol = zero_pixels[indx, 1]
-        temp = data[pixrow-1:pixrow+2, pixcol-1:pixcol+2]
-        if temp.size != 0 and temp.sum() > threshold and sum(sum(temp != 0)) >= nb_neighbours:
-            # mask/interpolate if at least 3 photons in each neighboring pixels
-            nb_pixels = nb_pixels + 1
-            if interpolate == 'interp_isolated':
-                value = temp.sum() / sum(sum(temp != 0))
+    nby, nbx = data.shape
+    zero_pixels = data == 0
+    zero_pixels[0, :] = False  # the neighbourhood of pixels in the first row or column is empty (negative index)
+    zero_pixels[:, 0] = False
+    # sum and number of non-zero pixels in the 3x3 neighbourhood of each pixel, the array being cropped at the edges.
+    # The 3x3 box kernel is separable, it is applied as two 1D correlations along each axis.
+    sum_neighbours = correlate1d(correlate1d(data.astype(float), np.ones(3), axis=0, mode='constant', cval=0),
+                                 np.ones(3), axis=1, mode='constant', cval=0)
+    nb_nonzero = correlate1d(correlate1d((data != 0).astype(np.uint8), np.ones(3), axis=0, mode='constant', cval=0),
+                             np.ones(3), axis=1, mode='constant', cval=0)  # at most 9, fits in uint8
+    # mask/interpolate if at least min_count photons in each neighboring pixels
+    candidates = zero_pixels & (sum_neighbours > threshold) & (nb_nonzero >= nb_neighbours)
+
+    if interpolate == 'interp_isolated':
+        # an interpolated pixel changes the neighbourhood of the next zero pixels (in row-major order). Process the
+        # candidates in this order, and queue the next zero pixels around each interpolated pixel to check them again.
+        nb_pixels = 0
+        queue = list(np.flatnonzero(candidates))  # sorted, hence already a heap
+        queued = set(queue)
+        while queue:
+            index = heapq.heappop(queue)
+            pixrow, pixcol = divmod(index, nbx)
+            if sum_neighbours[pixrow, pixcol] > threshold and nb_nonzero[pixrow, pixcol] >= nb_neighbours:
+                nb_pixels = nb_pixels + 1
+                value = sum_neighbours[pixrow, pixcol] / nb_nonzero[pixrow, pixcol]
                 data[pixrow, pixcol] = value
                 mask[pixrow, pixcol] = 0
-            else:
-                mask[pixrow, pixcol] = 1
+                sum_neighbours[pixrow-1:pixrow+2, pixcol-1:pixcol+2] += value
+                nb_nonzero[pixrow-1:pixrow+2, pixcol-1:pixcol+2] += value != 0
+                for row in range(pixrow, min(pixrow + 2, nby)):
+                    for col in range(pixcol - 1, min(pixcol + 2, nbx)):
+                        next_index = row * nbx + col
+                        if next_index > index and zero_pixels[row, col] and next_index not in queued:
+                            heapq.heappush(queue, next_index)
+                            queued.add(next_index)
+    else:
+        mask[candidates] = 1
+        nb_pixels = np.count_nonzero(candidates)
     if interpolate == 'interp_isolated':
         print("Nb of filtered pixel: ", nb_pixels)
     else:
@@ -1913,13 +1860,14 @@ def motor_positions_cristal(logfile, setup):
         raise ValueError('Only out of plane rocking curve implemented for CRISTAL')
 
     if not setup.custom_scan:
-        group_key = list(logfile.keys())[0]
+        scan_group = logfile[list(logfile.keys())[0]]
+        diffractometer = scan_group['CRISTAL/Diffractometer']
 
-        mgomega = logfile['/' + group_key + '/scan_data/actuator_1_1'][:] / 1e6  # mgomega is scanned
+        mgomega = scan_group['scan_data/actuator_1_1'][:] / 1e6  # mgomega is scanned
 
-        delta = logfile['/' + group_key + '/CRISTAL/Diffractometer/I06-C-C07-EX-DIF-DELTA/position'][:]
+        delta = diffractometer['I06-C-C07-EX-DIF-DELTA/position'][:]
 
-        gamma = logfile['/' + group_key + '/CRISTAL/Diffractometer/I06-C-C07-EX-DIF-GAMMA/position'][:]
+        gamma = diffractometer['I06-C-C07-EX-DIF-GAMMA/position'][:]
     else:
         mgomega = setup.custom_motors["mgomega"] / 1e6
         delta = setup.custom_motors["delta"]
@@ -2025,18 +1973,16 @@ def motor_positions_p10(logfile, setup):
     :return: (om, phi, chi, mu, gamma, delta) motor positions
     """
     if not setup.custom_scan:
-        fio = open(logfile, 'r')
-        if setup.rocking_angle == "outofplane":
-            om = []
-        elif setup.rocking_angle == "inplane":
-            phi = []
-        else:
+        if setup.rocking_angle != "outofplane" and setup.rocking_angle != "inplane":
             raise ValueError('Wrong value for "rocking_angle" parameter')
 
-        fio_lines = fio.readlines()
-        for line in fio_lines:
-            this_line = line.strip()
-            words = this_line.split()
+        with open(logfile, 'r') as fio:
+            fio_lines = fio.readlines()
+
+        # parse the header until the first data line
+        data_start = len(fio_lines)
+        for line_nb, line in enumerate(fio_lines):
+            words = line.split()
 
             if 'Col' in words and 'om' in words:  # om scanned, template = ' Col 0 om DOUBLE\n'
                 index_om = int(words[1]) - 1  # python index starts at 0
@@ -2059,19 +2005,16 @@ def motor_positions_p10(logfile, setup):
 
             try:
                 float(words[0])  # if this does not fail, we are reading data
-                if setup.rocking_angle == "outofplane":
-                    om.append(float(words[index_om]))
-                else:  # phi
-                    phi.append(float(words[index_phi]))
-            except ValueError:  # first word is not a number, skip this line
+                data_start = line_nb
+                break
+            except (ValueError, IndexError):  # first word is not a number or empty line, skip this line
                 continue
 
+        # parse all data lines at once, the end of the acquisition is commented with '!'
         if setup.rocking_angle == "outofplane":
-            om = np.asarray(om, dtype=float)
+            om = np.loadtxt(fio_lines[data_start:], usecols=index_om, comments='!', ndmin=1)
         else:  # phi
-            phi = np.asarray(phi, dtype=float)
-
-        fio.close()
+            phi = np.loadtxt(fio_lines[data_start:], usecols=index_phi, comments='!', ndmin=1)
 
     else:
         om = setup.custom_motors["om"]
@@ -2106,13 +2049,7 @@ def motor_positions_sixs(logfile, frames_logical, setup):
 
         temp_mu = logfile.mu[:]
 
-        mu = np.zeros((frames_logical != 0).sum())  # first frame is duplicated for SIXS_2018
-        nb_overlap = 0
-        for idx in range(len(frames_logical)):
-            if frames_logical[idx]:
-                mu[idx - nb_overlap] = temp_mu[idx]
-            else:
-                nb_overlap = nb_overlap + 1
+        mu = temp_mu[np.flatnonzero(frames_logical)].astype(float)  # first frame is duplicated for SIXS_2018
     else:
         beta = setup.custom_motors["beta"]
         delta = setup.custom_motors["delta"]
@@ -2200,21 +2137,13 @@ def normalize_dataset(array, raw_monitor, frames_logical, norm_to_min=False, deb
         gu.imshow_plot(array=array, sum_frames=True, sum_axis=1, vmin=0, scale='log', title='Data before normalization')
 
     # crop/pad monitor depending on frames_logical array
-    monitor = np.zeros((frames_logical != 0).sum())
     print('frames_logical: length=', frames_logical.shape, 'value=\n', frames_logical)
-    nb_overlap = 0
-    nb_padded = 0
-    for idx in range(len(frames_logical)):
-        if frames_logical[idx] == -1:  # padded frame, no monitor value for this
-            if norm_to_min:
-                monitor[idx - nb_overlap] = raw_monitor.min()
-            else:  # norm to max
-                monitor[idx - nb_overlap] = raw_monitor.max()
-            nb_padded = nb_padded + 1
-        elif frames_logical[idx] == 1:
-            monitor[idx - nb_overlap] = raw_monitor[idx-nb_padded]
-        else:
-            nb_overlap = nb_overlap + 1
+    # padded frames have no monitor value, the raw monitor is indexed by the position among measured frames
+    nb_padded = np.count_nonzero(frames_logical == -1)
+    raw_index = np.cumsum(frames_logical != -1) - 1
+    monitor = np.full(len(frames_logical), raw_monitor.min() if norm_to_min else raw_monitor.max(), dtype=float)
+    monitor[frames_logical == 1] = raw_monitor[raw_index[frames_logical == 1]]
+    monitor = monitor[frames_logical != 0]  # remove unused frames
     if nb_padded != 0:
         print('Monitor value set to 1 for ', nb_padded, ' frames padded')
 
@@ -2230,8 +2159,9 @@ def normalize_dataset(array, raw_monitor, frames_logical, norm_to_min=False, deb
         raise ValueError('The frame number and the monitor data length are different:'
                          ' Got ', nbz, 'frames but ', len(monitor), ' monitor values')
 
-    for idx in range(nbz):
-        array[idx, :, :] = array[idx, :, :] * monitor[idx]
+    # the multiplication loop runs in the precision of the data (float32 data is not promoted to float64)
+    monitor_3d = monitor.astype(np.result_type(array.dtype, np.float32), copy=False)[:, np.newaxis, np.newaxis]
+    np.multiply(array, monitor_3d, out=array, casting='unsafe')
 
     return array, monitor, title
 
@@ -2248,12 +2178,22 @@ def primes(number):
 
     list_primes = [1]
     assert (number > 0)
-    i = 2
-    while i * i <= number:
-        while number % i == 0:
-            list_primes.append(i)
-            number //= i
-        i += 1
+    for divider in (2, 3, 5):
+        while number % divider == 0:
+            list_primes.append(divider)
+            number //= divider
+    # wheel factorization: only the numbers coprime with 2*3*5 are tested as dividers (7, 11, 13, 17, 19, 23, 29, 31...)
+    increments = (4, 2, 4, 2, 4, 6, 2, 6)
+    divider = 7
+    idx = 0
+    limit = isqrt(number)
+    while divider <= limit:
+        while number % divider == 0:
+            list_primes.append(divider)
+            number //= divider
+            limit = isqrt(number)
+        divider += increments[idx]
+        idx = (idx + 1) % 8
     if number > 1:
         list_primes.append(number)
     return list_primes
@@ -2553,8 +2493,9 @@ def regrid_cdi(data, mask, logfile, detector, setup, frames_logical, interpolate
         newmask = rgi(np.concatenate((angle_det.reshape((1, z_interp.size)),
                                       y_det.reshape((1, z_interp.size)),
                                       x_det.reshape((1, z_interp.size)))).transpose())
-        newmask = newmask.reshape((numz, numy, numx)).astype(mask.dtype)
-        newmask[np.nonzero(newmask)] = 1
+        newmask = newmask.reshape((numz, numy, numx))
+        newmask[np.nonzero(newmask)] = 1  # before casting, partially masked voxels would be lost for integer masks
+        newmask = newmask.astype(mask.dtype)
 
     else:
         from scipy.interpolate import griddata
@@ -2582,7 +2523,9 @@ def regrid_cdi(data, mask, logfile, detector, setup, frames_logical, interpolate
             np.ndarray.flatten(mask),
             np.array([np.ndarray.flatten(new_qx), np.ndarray.flatten(new_qz), np.ndarray.flatten(new_qy)]).T,
             method='linear', fill_value=np.nan)
-        newmask = newmask.reshape((numz, numy, numx)).astype(mask.dtype)
+        newmask = newmask.reshape((numz, numy, numx))
+        newmask[np.nonzero(newmask)] = 1  # before casting, partially masked voxels would be lost for integer masks
+        newmask = newmask.astype(mask.dtype)
 
     # check for Nan
     newmask[np.isnan(newdata)] = 1
@@ -2627,33 +2570,26 @@ def remove_hotpixels(data, mask, hotpixels=None):
     :param mask: array of the same shape as data
     :return: the data without hotpixels and the updated mask
     """
-    if hotpixels is None:
-        hotpixels = np.zeros(data.shape)
+    if data.shape != mask.shape:
+        raise ValueError('Data and mask must have the same shape\n data is ', data.shape, ' while mask is ', mask.shape)
+    if data.ndim != 2 and data.ndim != 3:
+        raise ValueError('2D or 3D data array expected, got ', data.ndim, 'D')
+
+    if hotpixels is None:  # nothing to remove
+        return data, mask
     if hotpixels.ndim == 3:  # 3D array
         print('Hotpixels is a 3D array, summing along the first axis')
         hotpixels = hotpixels.sum(axis=0)
         hotpixels[np.nonzero(hotpixels)] = 1  # hotpixels should be a binary array
 
-    if data.shape != mask.shape:
-        raise ValueError('Data and mask must have the same shape\n data is ', data.shape, ' while mask is ', mask.shape)
+    if data.shape[-2:] != hotpixels.shape:
+        raise ValueError('Data and hotpixels must have the same shape\n data is ',
+                         data.shape, ' while hotpixels is ', hotpixels.shape)
 
-    if data.ndim == 3:  # 3D array
-        if data[0, :, :].shape != hotpixels.shape:
-            raise ValueError('Data and hotpixels must have the same shape\n data is ',
-                             data.shape, ' while hotpixels is ', hotpixels.shape)
-        for idx in range(data.shape[0]):
-            temp_data = data[idx, :, :]
-            temp_mask = mask[idx, :, :]
-            temp_data[hotpixels == 1] = 0  # numpy array is mutable hence data will be modified
-            temp_mask[hotpixels == 1] = 1  # numpy array is mutable hence mask will be modified
-    elif data.ndim == 2:  # 2D array
-        if data.shape != hotpixels.shape:
-            raise ValueError('Data and hotpixels must have the same shape\n data is ',
-                             data.shape, ' while hotpixels is ', hotpixels.shape)
-        data[hotpixels == 1] = 0
-        mask[hotpixels == 1] = 1
-    else:
-        raise ValueError('2D or 3D data array expected, got ', data.ndim, 'D')
+    # compare hotpixels only once, the boolean array indexes the last two axes of 2D or 3D data
+    hot_bool = hotpixels == 1
+    data[..., hot_bool] = 0  # numpy array is mutable hence data will be modified
+    mask[..., hot_bool] = 1  # numpy array is mutable hence mask will be modified
     return data, mask
 
 
@@ -2674,6 +2610,17 @@ def sign(angle, z_coord, x_coord):
     return sign_array
 
 
+@lru_cache(maxsize=8)
+def small_primes(maxprime):
+    """
+    Generate the prime numbers <=maxprime. Results are cached.
+
+    :param maxprime: the largest integer to consider
+    :return: a tuple of the prime numbers <=maxprime, in increasing order
+    """
+    return tuple(number for number in range(2, int(maxprime) + 1) if primes(number) == [1, number])
+
+
 def smaller_primes(number, maxprime=13, required_dividers=(4,)):
     """
     Find the closest integer <=n (or list/array of integers), for which the largest prime divider is <=maxprime,
@@ -2686,24 +2633,50 @@ def smaller_primes(number, maxprime=13, required_dividers=(4,)):
     :return: the integer (or list/array of integers) fulfilling the requirements
     """
     if (type(number) is list) or (type(number) is tuple) or (type(number) is np.ndarray):
-        vn = []
-        for i in number:
-            assert (i > 1 and maxprime <= i)
-            while try_smaller_primes(i, maxprime=maxprime, required_dividers=required_dividers) is False:
-                i = i - 1
-                if i == 0:
-                    return 0
-            vn.append(i)
+        numbers = np.asarray(number)
+        assert (numbers.min() > 1 and maxprime <= numbers.min())
+        lcm = 1 if required_dividers is None else int(np.lcm.reduce(required_dividers))
+        limit = 1 << (int(numbers.max()) - 1).bit_length()  # power of 2 to share cached tables
+        candidates = smooth_numbers(maxprime=maxprime, limit=limit)
+        candidates = candidates[candidates % lcm == 0]
+        # index of the largest candidate <= number, for all numbers at once
+        indices = np.searchsorted(candidates, numbers, side='right') - 1
+        if indices.min() < 0:
+            return 0
         if type(number) is np.ndarray:
-            return np.array(vn)
-        return vn
+            return candidates[indices]
+        return [int(val) for val in candidates[indices]]
     else:
         assert (number > 1 and maxprime <= number)
-        while try_smaller_primes(number, maxprime=maxprime, required_dividers=required_dividers) is False:
-            number = number - 1
-            if number == 0:
-                return 0
-        return number
+        lcm = 1 if required_dividers is None else int(np.lcm.reduce(required_dividers))
+        limit = 1 << (int(number) - 1).bit_length()  # power of 2 to share cached tables
+        candidates = smooth_numbers(maxprime=maxprime, limit=limit)
+        candidates = candidates[(candidates <= number) & (candidates % lcm == 0)]
+        if candidates.size == 0:
+            return 0
+        return int(candidates[-1])
+
+
+@lru_cache(maxsize=32)
+def smooth_numbers(maxprime, limit):
+    """
+    Generate the sorted array of integers <=limit for which the largest prime divider is <=maxprime. Results are
+    cached, the returned array is read-only.
+
+    :param maxprime: the largest prime factor acceptable
+    :param limit: the largest integer to consider
+    :return: a sorted 1D array of integers
+    """
+    numbers = np.ones(1, dtype=np.int64)
+    for prime in small_primes(maxprime):
+        powers = [1]
+        while powers[-1] * prime <= limit:
+            powers.append(powers[-1] * prime)
+        numbers = np.outer(numbers, np.asarray(powers, dtype=np.int64)).ravel()
+        numbers = numbers[numbers <= limit]
+    numbers = np.sort(numbers)
+    numbers.flags.writeable = False  # the cached array is shared between calls
+    return numbers
 
 
 def try_smaller_primes(number, maxprime=13, required_dividers=(4,)):
@@ -2716,14 +2689,16 @@ def try_smaller_primes(number, maxprime=13, required_dividers=(4,)):
     :param required_dividers: list of required dividers in the prime decomposition. If None, this check is skipped.
     :return: True if the conditions are met.
     """
-    p = primes(number)
-    if max(p) > maxprime:
-        return False
+    assert (number > 0)
     if required_dividers is not None:
         for k in required_dividers:
             if number % k != 0:
                 return False
-    return True
+    # divide out all prime factors <=maxprime, there is no need for the full prime decomposition
+    for divider in small_primes(maxprime):
+        while number % divider == 0:
+            number //= divider
+    return number == 1
 
 
 def update_aliens(key, pix, piy, original_data, updated_data, updated_mask, figure, width, dim, idx,
@@ -2748,71 +2723,20 @@ def update_aliens(key, pix, piy, original_data, updated_data, updated_mask, figu
     if original_data.ndim != 3 or updated_data.ndim != 3 or updated_mask.ndim != 3:
         raise ValueError('original_data, updated_data and updated_mask should be 3D arrays')
 
-    nbz, nby, nbx = original_data.shape
     stop_masking = False
     if dim > 2:
         raise ValueError('dim should be 0, 1 or 2')
+    nb_frames = original_data.shape[dim]
 
-    myaxs = figure.gca()
-    xmin, xmax = myaxs.get_xlim()
-    ymin, ymax = myaxs.get_ylim()
     if key == 'u':  # show next frame
         idx = idx + 1
-        figure.clear()
-        if dim == 0:
-            if idx > nbz - 1:
-                idx = 0
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            if idx > nby - 1:
-                idx = 0
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            if idx > nbx - 1:
-                idx = 0
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
+        if idx > nb_frames - 1:
+            idx = 0
 
     elif key == 'd':  # show previous frame
         idx = idx - 1
-        figure.clear()
-        if dim == 0:
-            if idx < 0:
-                idx = nbz - 1
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            if idx < 0:
-                idx = nby - 1
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            if idx < 0:
-                idx = nbx - 1
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
+        if idx < 0:
+            idx = nb_frames - 1
 
     elif key == 'up':
         width = width + 1
@@ -2824,185 +2748,41 @@ def update_aliens(key, pix, piy, original_data, updated_data, updated_mask, figu
 
     elif key == 'right':  # increase colobar max
         vmax = vmax * 2
-        figure.clear()
-        if dim == 0:
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
 
     elif key == 'left':  # reduce colobar max
         vmax = vmax / 2
         if vmax < 1:
             vmax = 1
-        figure.clear()
-        if dim == 0:
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
 
-    elif key == 'm':  # mask intensities
-        figure.clear()
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        if dim == 0:
-            updated_data[idx, starty:piy + width + 1, startx:pix + width + 1] = 0
-            updated_mask[idx, starty:piy + width + 1, startx:pix + width + 1] = 1
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            updated_data[starty:piy + width + 1, idx, startx:pix + width + 1] = 0
-            updated_mask[starty:piy + width + 1, idx, startx:pix + width + 1] = 1
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            updated_data[starty:piy + width + 1, startx:pix + width + 1, idx] = 0
-            updated_mask[starty:piy + width + 1, startx:pix + width + 1, idx] = 1
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
-
-    elif key == 'b':  # back to measured intensities
-        figure.clear()
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        if dim == 0:
-            updated_data[idx, starty:piy + width + 1, startx:pix + width + 1] = \
-                original_data[idx, starty:piy + width + 1, startx:pix + width + 1]
-            updated_mask[idx, starty:piy + width + 1, startx:pix + width + 1] = 0
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            updated_data[starty:piy + width + 1, idx, startx:pix + width + 1] = \
-                original_data[starty:piy + width + 1, idx, startx:pix + width + 1]
-            updated_mask[starty:piy + width + 1, idx, startx:pix + width + 1] = 0
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            updated_data[starty:piy + width + 1, startx:pix + width + 1, idx] = \
-                original_data[starty:piy + width + 1, startx:pix + width + 1, idx]
-            updated_mask[starty:piy + width + 1, startx:pix + width + 1, idx] = 0
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
-
-    elif key == 'f':  # fill with 1
-        figure.clear()
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        if dim == 0:
-            updated_data[idx, starty:piy + width + 1, startx:pix + width + 1] = 1
-            updated_mask[idx, starty:piy + width + 1, startx:pix + width + 1] = 1
-            plt.imshow(updated_data[idx, :, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            updated_data[starty:piy + width + 1, idx, startx:pix + width + 1] = 1
-            updated_mask[starty:piy + width + 1, idx, startx:pix + width + 1] = 1
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            updated_data[starty:piy + width + 1, startx:pix + width + 1, idx] = 1
-            updated_mask[starty:piy + width + 1, startx:pix + width + 1, idx] = 1
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
-
-    elif key == 'p':  # plot full image
-        figure.clear()
-        if dim == 0:
-            plt.imshow(updated_data[idx, :, ], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbz) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 1:
-            plt.imshow(updated_data[:, idx, :], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nby) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        elif dim == 2:
-            plt.imshow(updated_data[:, :, idx], vmin=vmin, vmax=vmax)
-            plt.title("Frame " + str(idx + 1) + "/" + str(nbx) + "\n"
-                      "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                      "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
+    elif key == 'm' or key == 'b' or key == 'f':  # mask intensities, back to measured intensities or fill with 1
+        starty = max(piy - width, 0)
+        startx = max(pix - width, 0)
+        region = (np.s_[idx, starty:piy + width + 1, startx:pix + width + 1],
+                  np.s_[starty:piy + width + 1, idx, startx:pix + width + 1],
+                  np.s_[starty:piy + width + 1, startx:pix + width + 1, idx])[dim]
+        if key == 'm':
+            updated_data[region] = 0
+            updated_mask[region] = 1
+        elif key == 'b':
+            updated_data[region] = original_data[region]
+            updated_mask[region] = 0
+        else:  # key == 'f'
+            updated_data[region] = 1
+            updated_mask[region] = 1
 
     elif key == 'q':
         stop_masking = True
 
+    if key in ('u', 'd', 'right', 'left', 'm', 'b', 'f', 'p'):  # 'p' plots the full image
+        if key in ('u', 'd', 'p'):  # the title changes only with the frame
+            title = "Frame " + str(idx + 1) + "/" + str(nb_frames) + "\n" \
+                    "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n" \
+                    "up larger ; down smaller ; right darker ; left brighter"
+        else:
+            title = None
+        update_image(figure=figure, array=updated_data[(np.s_[idx, :, :], np.s_[:, idx, :], np.s_[:, :, idx])[dim]],
+                     vmin=vmin, vmax=vmax, title=title, reset_view=key == 'p')
+
     return updated_data, updated_mask, width, vmax, idx, stop_masking
 
 
@@ -3027,9 +2807,6 @@ def update_aliens_2d(key, pix, piy, original_data, updated_data, updated_mask, f
         raise ValueError('original_data, updated_data and updated_mask should be 2D arrays')
 
     stop_masking = False
-    myaxs = figure.gca()
-    xmin, xmax = myaxs.get_xlim()
-    ymin, ymax = myaxs.get_ylim()
     if key == 'up':
         width = width + 1
 
@@ -3040,83 +2817,32 @@ def update_aliens_2d(key, pix, piy, original_data, updated_data, updated_mask, f
 
     elif key == 'right':
         vmax = vmax * 2
-        figure.clear()
-
-        plt.imshow(updated_data, vmin=vmin, vmax=vmax)
-        plt.title("m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
 
     elif key == 'left':
         vmax = vmax / 2
         if vmax < 1:
             vmax = 1
-        figure.clear()
-
-        plt.imshow(updated_data, vmin=vmin, vmax=vmax)
-        plt.title("m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
-
-    elif key == 'm':
-        figure.clear()
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-
-        updated_data[starty:piy + width + 1, startx:pix + width + 1] = 0
-        updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 1
-        plt.imshow(updated_data, vmin=vmin, vmax=vmax)
-        plt.title("m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
 
-    elif key == 'b':
-        figure.clear()
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-
-        updated_data[starty:piy + width + 1, startx:pix + width + 1] = \
-            original_data[starty:piy + width + 1, startx:pix + width + 1]
-        updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 0
-        plt.imshow(updated_data, vmin=vmin, vmax=vmax)
-        plt.title("m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        myaxs = figure.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.draw()
-
-    elif key == 'p':  # plot full image
-        figure.clear()
-        plt.imshow(updated_data, vmin=vmin, vmax=vmax)
-        plt.title("m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
+    elif key == 'm' or key == 'b':
+        starty = max(piy - width, 0)
+        startx = max(pix - width, 0)
+        if key == 'm':
+            updated_data[starty:piy + width + 1, startx:pix + width + 1] = 0
+            updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 1
+        else:  # key == 'b'
+            updated_data[starty:piy + width + 1, startx:pix + width + 1] = \
+                original_data[starty:piy + width + 1, startx:pix + width + 1]
+            updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 0
 
     elif key == 'q':
         stop_masking = True
 
+    if key in ('right', 'left', 'm', 'b', 'p'):  # 'p' plots the full image
+        update_image(figure=figure, array=updated_data, vmin=vmin, vmax=vmax,
+                     title="m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
+                           "up larger ; down smaller ; right darker ; left brighter" if key == 'p' else None,
+                     reset_view=key == 'p')
+
     return updated_data, updated_mask, width, vmax, stop_masking
 
 
@@ -3222,8 +2948,51 @@ def update_background(key, distances, data, figure, flag_pause, xy, scale='log',
     return flag_pause, xy, stop_masking
 
 
-def update_mask(key, pix, piy, original_data, original_mask, updated_data, updated_mask, figure, flag_pause, points,
-                xy, width, dim, vmax, vmin=0, masked_color=0.1):
+def update_image(figure, array, vmin, vmax, title=None, reset_view=False):
+    """
+    Update in place the image displayed in the current axes of the figure, instead of clearing the figure and
+    plotting it again. The current zoom is kept unless reset_view is True.
+
+    :param figure: the figure instance
+    :param array: the 2D array to display
+    :param vmin: the lower boundary for the colorbar
+    :param vmax: the higher boundary for the colorbar
+    :param title: the title of the plot, None to keep the current title
+    :param reset_view: set to True to show the full image
+    :return: nothing
+    """
+    myaxs = figure.gca()
+    full_draw = reset_view
+    if myaxs.images:
+        image = myaxs.images[0]
+        if image.get_array().shape != array.shape:
+            reset_view = True
+        image.set_data(array)
+        image.set_clim(vmin, vmax)
+    else:  # nothing plotted yet
+        image = myaxs.imshow(array, vmin=vmin, vmax=vmax)
+        full_draw = True
+    if reset_view:
+        nby, nbx = array.shape
+        image.set_extent((-0.5, nbx - 0.5, nby - 0.5, -0.5))
+        myaxs.set_xlim(-0.5, nbx - 0.5)
+        myaxs.set_ylim(nby - 0.5, -0.5)
+        full_draw = True
+    if title is not None and title != myaxs.get_title():  # the layout of the title text is expensive
+        myaxs.set_title(title)
+        full_draw = True
+    if full_draw or not figure.canvas.supports_blit:
+        figure.canvas.draw_idle()
+    else:  # only the pixels of the image changed, blit the axes area instead of rendering the whole figure
+        myaxs.draw_artist(myaxs.patch)
+        myaxs.draw_artist(image)
+        for spine in myaxs.spines.values():
+            myaxs.draw_artist(spine)
+        figure.canvas.blit(myaxs.bbox)
+
+
+def update_mask(key, pix, piy, original_data, original_mask, updated_data, updated_mask, figure, flag_pause, xy,
+                width, dim, vmax, vmin=0, masked_color=0.1):
     """
     Update the mask to remove parasitic diffraction intensity and hotpixels in 3D dataset.
 
@@ -3233,11 +3002,9 @@ def update_mask(key, pix, piy, original_data, original_mask, updated_data, updat
     :param original_data: the 3D data array before masking
     :param original_mask: the 3D mask array before masking
     :param updated_data: the current 3D data array
-    :param updated_mask: the temporary 2D mask array with updated points
+    :param updated_mask: the temporary 2D mask array with updated points, of dtype uint8 (nonzero values are masked)
     :param figure: the figure instance
     :param flag_pause: set to 1 to stop registering vertices using mouse clicks
-    :param points: list of all point coordinates: points=np.stack((x, y), axis=0).T with x=x.flatten() , y = y.flatten()
-     given x,y=np.meshgrid(np.arange(nx), np.arange(ny))
     :param xy: the list of vertices which defines a polygon to be masked
     :param width: the half_width of the masking window
     :param dim: the axis currently under review (axis 0, 1 or 2)
@@ -3251,7 +3018,6 @@ def update_mask(key, pix, piy, original_data, original_mask, updated_data, updat
     if updated_mask.ndim != 2:
         raise ValueError('updated_mask should be 2D arrays')
 
-    nbz, nby, nbx = original_data.shape
     stop_masking = False
     if dim != 0 and dim != 1 and dim != 2:
         raise ValueError('dim should be 0, 1 or 2')
@@ -3266,145 +3032,42 @@ def update_mask(key, pix, piy, original_data, original_mask, updated_data, updat
 
     elif key == 'right':
         vmax = vmax + 1
-        array = updated_data.sum(axis=dim)
-        array[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(array)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
 
     elif key == 'left':
         vmax = vmax - 1
         if vmax < 1:
             vmax = 1
-        array = updated_data.sum(axis=dim)
-        array[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(array)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
-
-    elif key == 'm':
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 1
-        array = updated_data.sum(axis=dim)
-        array[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(array)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
 
-    elif key == 'b':
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 0
-        array = updated_data.sum(axis=dim)
-        array[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(array)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
+    elif key == 'm' or key == 'b':
+        starty = max(piy - width, 0)
+        startx = max(pix - width, 0)
+        if key == 'm':
+            updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 1
+        else:  # key == 'b'
+            updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 0
 
     elif key == 'a':  # restart mask from beginning
-        updated_data = np.copy(original_data)
+        np.copyto(updated_data, original_data)  # reuse the buffers instead of allocating new arrays
         xy = []
         print('restart masking')
-        if dim == 0:
-            updated_data[
-                original_mask == 1] = masked_color / nbz  # masked pixels plotted with the value of masked_pixel
-            updated_mask = np.zeros((nby, nbx))
-        if dim == 1:
-            updated_data[
-                original_mask == 1] = masked_color / nby  # masked pixels plotted with the value of masked_pixel
-            updated_mask = np.zeros((nbz, nbx))
-        if dim == 2:
-            updated_data[
-                original_mask == 1] = masked_color / nbx  # masked pixels plotted with the value of masked_pixel
-            updated_mask = np.zeros((nbz, nby))
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data.sum(axis=dim))), vmin=0, vmax=vmax)
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
+        # masked pixels plotted with the value of masked_pixel once summed along dim
+        np.putmask(updated_data, original_mask, masked_color / original_data.shape[dim])
+        updated_mask.fill(0)
 
     elif key == 'p':  # plot masked image
         if len(xy) != 0:
             xy.append(xy[0])
             print(xy)
-            if dim == 0:
-                ind = Path(np.array(xy)).contains_points(points).reshape((nby, nbx))
-            elif dim == 1:
-                ind = Path(np.array(xy)).contains_points(points).reshape((nbz, nbx))
-            else:  # dim=2
-                ind = Path(np.array(xy)).contains_points(points).reshape((nbz, nby))
-            updated_mask[ind] = 1
-        array = updated_data.sum(axis=dim)
-        array[updated_mask == 1] = masked_color
+            nby, nbx = updated_mask.shape
+            vertices = np.array(xy)
+            # only the pixels in the bounding box of the polygon need to be tested
+            xmin, ymin = np.maximum(np.floor(vertices.min(axis=0)).astype(int), 0)
+            xmax, ymax = np.ceil(vertices.max(axis=0)).astype(int) + 1
+            x, y = np.meshgrid(np.arange(xmin, min(xmax, nbx)), np.arange(ymin, min(ymax, nby)))
+            ind = Path(vertices).contains_points(np.stack((x.flatten(), y.flatten()), axis=0).T).reshape(x.shape)
+            updated_mask[ymin:ymin + ind.shape[0], xmin:xmin + ind.shape[1]][ind] = 1
         xy = []  # allow to mask a different area
-        figure.clear()
-        plt.imshow(np.log10(abs(array)), vmin=vmin, vmax=vmax)
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
-        thismanager = plt.get_current_fig_manager()
-        thismanager.toolbar.pan()  # deactivate the pan
+
     elif key == 'x':
         if not flag_pause:
             flag_pause = True
@@ -3416,11 +3079,38 @@ def update_mask(key, pix, piy, original_data, original_mask, updated_data, updat
     elif key == 'q':
         stop_masking = True
 
+    if key in ('right', 'left', 'm', 'b', 'a', 'p'):  # 'a' and 'p' plot the full image
+        # updated_data changes only when restarting, the log10 of its projection is computed once per figure and
+        # then reused. Pixels without intensity are displayed as 0
+        cached_dim, log_projection = getattr(figure, 'data_projection', (None, None))
+        if key == 'a' or cached_dim != dim:
+            log_projection = abs(updated_data.sum(axis=dim)).astype(np.float32)  # same dtype as the displayed buffer
+            np.log10(log_projection, out=log_projection, where=log_projection > 0)
+            figure.data_projection = (dim, log_projection)
+        # the displayed image is assembled in a float32 buffer reused between key presses
+        log_array = getattr(figure, 'log_buffer', None)
+        if log_array is None or log_array.shape != log_projection.shape:
+            log_array = np.empty(log_projection.shape, dtype=np.float32)
+            figure.log_buffer = log_array
+        np.copyto(log_array, log_projection)
+        masked_log = np.abs(np.full(1, masked_color, dtype=np.float32))
+        np.log10(masked_log, out=masked_log, where=masked_log > 0)
+        np.putmask(log_array, updated_mask, masked_log)  # the mask is binary, nonzero values are masked
+        update_image(figure=figure, array=log_array, vmin=vmin, vmax=vmax,
+                     title='x to pause/resume masking for pan/zoom \n'
+                           'p plot mask ; a restart ; click to select vertices\n'
+                           "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
+                           "up larger ; down smaller ; right darker ; left brighter" if key in ('a', 'p') else None,
+                     reset_view=key == 'a' or key == 'p')
+        if key == 'p':
+            thismanager = plt.get_current_fig_manager()
+            thismanager.toolbar.pan()  # deactivate the pan
+
     return updated_data, updated_mask, flag_pause, xy, width, vmax, stop_masking
 
 
-def update_mask_2d(key, pix, piy, original_data, original_mask, updated_data, updated_mask, figure, flag_pause, points,
-                   xy, width, vmax, vmin=0, masked_color=0.1):
+def update_mask_2d(key, pix, piy, original_data, original_mask, updated_data, updated_mask, figure, flag_pause, xy,
+                   width, vmax, vmin=0, masked_color=0.1):
     """
     Update the mask to remove parasitic diffraction intensity and hotpixels for 2d dataset.
 
@@ -3430,11 +3120,9 @@ def update_mask_2d(key, pix, piy, original_data, original_mask, updated_data, up
     :param original_data: the 2D data array before masking
     :param original_mask: the 2D mask array before masking
     :param updated_data: the current 2D data array
-    :param updated_mask: the temporary 2D mask array with updated points
+    :param updated_mask: the temporary 2D mask array with updated points, of dtype uint8 (nonzero values are masked)
     :param figure: the figure instance
     :param flag_pause: set to 1 to stop registering vertices using mouse clicks
-    :param points: list of all point coordinates: points=np.stack((x, y), axis=0).T with x=x.flatten() , y = y.flatten()
-     given x,y=np.meshgrid(np.arange(nx), np.arange(ny))
     :param xy: the list of vertices which defines a polygon to be masked
     :param width: the half_width of the masking window
     :param vmax: the higher boundary for the colorbar
@@ -3458,129 +3146,41 @@ def update_mask_2d(key, pix, piy, original_data, original_mask, updated_data, up
 
     elif key == 'right':
         vmax = vmax + 1
-        updated_data[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
 
     elif key == 'left':
         vmax = vmax - 1
         if vmax < 1:
             vmax = 1
-        updated_data[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
 
-    elif key == 'm':
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 1
-        updated_data[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
-
-    elif key == 'b':
-        if (piy - width) < 0:
-            starty = 0
-        else:
-            starty = piy - width
-        if (pix - width) < 0:
-            startx = 0
-        else:
-            startx = pix - width
-        updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 0
-        updated_data[updated_mask == 1] = masked_color
-        myfig = plt.gcf()
-        myaxs = myfig.gca()
-        xmin, xmax = myaxs.get_xlim()
-        ymin, ymax = myaxs.get_ylim()
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data)), vmin=vmin, vmax=vmax)
-        myaxs = myfig.gca()
-        myaxs.set_xlim([xmin, xmax])
-        myaxs.set_ylim([ymin, ymax])
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
+    elif key == 'm' or key == 'b':
+        starty = max(piy - width, 0)
+        startx = max(pix - width, 0)
+        if key == 'm':
+            updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 1
+        else:  # key == 'b'
+            updated_mask[starty:piy + width + 1, startx:pix + width + 1] = 0
 
     elif key == 'a':  # restart mask from beginning
-        updated_data = np.copy(original_data)
+        np.copyto(updated_data, original_data)  # reuse the buffers instead of allocating new arrays
         xy = []
         print('restart masking')
 
-        updated_data[
-            original_mask == 1] = masked_color  # masked pixels plotted with the value of masked_pixel
-        updated_mask = np.zeros((nby, nbx))
-
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data)), vmin=0, vmax=vmax)
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
+        np.putmask(updated_data, original_mask, masked_color)  # masked pixels plotted with the value of masked_pixel
+        updated_mask.fill(0)
 
     elif key == 'p':  # plot masked image
         if len(xy) != 0:
             xy.append(xy[0])
             print(xy)
-            ind = Path(np.array(xy)).contains_points(points).reshape((nby, nbx))
-            updated_mask[ind] = 1
-
-        updated_data[updated_mask == 1] = masked_color
+            vertices = np.array(xy)
+            # only the pixels in the bounding box of the polygon need to be tested
+            xmin, ymin = np.maximum(np.floor(vertices.min(axis=0)).astype(int), 0)
+            xmax, ymax = np.ceil(vertices.max(axis=0)).astype(int) + 1
+            x, y = np.meshgrid(np.arange(xmin, min(xmax, nbx)), np.arange(ymin, min(ymax, nby)))
+            ind = Path(vertices).contains_points(np.stack((x.flatten(), y.flatten()), axis=0).T).reshape(x.shape)
+            updated_mask[ymin:ymin + ind.shape[0], xmin:xmin + ind.shape[1]][ind] = 1
         xy = []  # allow to mask a different area
-        figure.clear()
-        plt.imshow(np.log10(abs(updated_data)), vmin=vmin, vmax=vmax)
-        plt.title('x to pause/resume masking for pan/zoom \n'
-                  'p plot mask ; a restart ; click to select vertices\n'
-                  "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
-                  "up larger ; down smaller ; right darker ; left brighter")
-        plt.draw()
-        thismanager = plt.get_current_fig_manager()
-        thismanager.toolbar.pan()  # deactivate the pan
+
     elif key == 'x':
         if not flag_pause:
             flag_pause = True
@@ -3592,6 +3192,30 @@ def update_mask_2d(key, pix, piy, original_data, original_mask, updated_data, up
     elif key == 'q':
         stop_masking = True
 
+    if key in ('right', 'left', 'm', 'b', 'a', 'p'):  # 'a' and 'p' plot the full image
+        np.putmask(updated_data, updated_mask, masked_color)  # the mask is binary, nonzero values are masked
+        # the log10 of the displayed intensity is kept in a float32 buffer between key presses, updated_data changes
+        # only at masked pixels unless restarting. Pixels without intensity are displayed as 0
+        log_array = getattr(figure, 'log_buffer', None)
+        if key == 'a' or log_array is None or log_array.shape != updated_data.shape:
+            log_array = np.empty(updated_data.shape, dtype=np.float32)
+            figure.log_buffer = log_array
+            np.abs(updated_data, out=log_array, casting='same_kind')
+            np.log10(log_array, out=log_array, where=log_array > 0)
+        else:
+            masked_log = np.abs(np.full(1, masked_color, dtype=np.float32))
+            np.log10(masked_log, out=masked_log, where=masked_log > 0)
+            np.putmask(log_array, updated_mask, masked_log)
+        update_image(figure=figure, array=log_array, vmin=vmin, vmax=vmax,
+                     title='x to pause/resume masking for pan/zoom \n'
+                           'p plot mask ; a restart ; click to select vertices\n'
+                           "m mask ; b unmask ; q quit ; u next frame ; d previous frame\n"
+                           "up larger ; down smaller ; right darker ; left brighter" if key in ('a', 'p') else None,
+                     reset_view=key == 'a' or key == 'p')
+        if key == 'p':
+            thismanager = plt.get_current_fig_manager()
+            thismanager.toolbar.pan()  # deactivate the pan
+
     return updated_data, updated_mask, flag_pause, xy, width, vmax, stop_masking
 
 
@@ -3608,7 +3232,7 @@ def wrap(obj, start_angle, range_angle):
     return obj
 
 
-def zero_pad(array, padding_width=np.array([0, 0, 0, 0, 0, 0]), mask_flag=False, debugging=False):
+def zero_pad(array, padding_width=np.array([0, 0, 0, 0, 0, 0]), mask_flag=False, debugging=False, out=None):
     """
     Pad obj with zeros.
 
@@ -3618,7 +3242,9 @@ def zero_pad(array, padding_width=np.array([0, 0, 0, 0, 0, 0]), mask_flag=False,
     :type mask_flag: bool
     :param debugging: set to True to see plots
     :type debugging: bool
-    :return: obj padded with zeros
+    :param out: optional preallocated array of the padded shape and of the same dtype as array, where the result is
+     written instead of allocating a new array
+    :return: obj padded with zeros (ones if mask_flag is True), with the same dtype as array
     """
     if array.ndim != 3:
         raise ValueError('3D Array expected, got ', array.ndim, 'D')
@@ -3634,11 +3260,22 @@ def zero_pad(array, padding_width=np.array([0, 0, 0, 0, 0, 0]), mask_flag=False,
         gu.multislices_plot(array=array, sum_frames=False, plot_colorbar=True, vmin=0, vmax=1,
                             title='Array before padding')
 
-    if mask_flag:
-        newobj = np.ones((nbz + padding_z0 + padding_z1, nby + padding_y0 + padding_y1, nbx + padding_x0 + padding_x1))
+    new_shape = (nbz + padding_z0 + padding_z1, nby + padding_y0 + padding_y1, nbx + padding_x0 + padding_x1)
+    if out is None:
+        newobj = np.empty(new_shape, dtype=array.dtype)
     else:
-        newobj = np.zeros((nbz + padding_z0 + padding_z1, nby + padding_y0 + padding_y1, nbx + padding_x0 + padding_x1))
+        if out.shape != new_shape or out.dtype != array.dtype:
+            raise ValueError('out should be an array of shape', new_shape, 'and dtype', array.dtype)
+        newobj = out
+    # copy the array (which can be a cropped view) once in the interior and fill only the padded borders
     newobj[padding_z0:padding_z0 + nbz, padding_y0:padding_y0 + nby, padding_x0:padding_x0 + nbx] = array
+    value = 1 if mask_flag else 0
+    newobj[:padding_z0] = value
+    newobj[padding_z0 + nbz:] = value
+    newobj[padding_z0:padding_z0 + nbz, :padding_y0] = value
+    newobj[padding_z0:padding_z0 + nbz, padding_y0 + nby:] = value
+    newobj[padding_z0:padding_z0 + nbz, padding_y0:padding_y0 + nby, :padding_x0] = value
+    newobj[padding_z0:padding_z0 + nbz, padding_y0:padding_y0 + nby, padding_x0 + nbx:] = value
     if debugging:
         gu.multislices_plot(array=newobj, sum_frames=False, plot_colorbar=True, vmin=0, vmax=1,
                             title='Array after padding')
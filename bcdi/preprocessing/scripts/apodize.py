@@ -7,8 +7,8 @@
 #         Jerome Carnis, carnis_jerome@yahoo.fr
 
 import numpy as np
-from scipy.stats import multivariate_normal
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import tkinter as tk
 from tkinter import filedialog
 import sys
@@ -34,7 +34,6 @@ window_type = 'blackman'  # 'normal' or 'tukey' or 'blackman'
 #############################
 mu = np.array([0.0, 0.0, 0.0])
 sigma = np.array([0.30, 0.30, 0.30])
-covariance = np.diag(sigma**2)
 ################################
 # parameter for a tukey window #
 ################################
@@ -46,23 +45,26 @@ plt.ion()
 root = tk.Tk()
 root.withdraw()
 file_path = filedialog.askopenfilename(initialdir=datadir, filetypes=[("NPZ", "*.npz"), ("NPY", "*.npy")])
-data = np.load(file_path)['data']
+data = np.load(file_path)['data'].astype(np.float32, copy=False)  # intensities do not need double precision
 nbz, nby, nbx = data.shape
-print(data.max())
 maxdata = data.max()
+print(maxdata)
 
 plt.figure()
-plt.imshow(np.log10(data.sum(axis=0)), vmin=0, vmax=6)
+plt.imshow(data.sum(axis=0), norm=LogNorm(vmin=1, vmax=1e6))  # the log scale is applied by the colormap
 plt.colorbar()
 plt.title('Initial diffraction pattern')
 plt.pause(0.1)
 
 if window_type == 'normal':
     comment = comment + 'normal'
-    grid_z, grid_y, grid_x = np.meshgrid(np.linspace(-1, 1, nbz), np.linspace(-1, 1, nby), np.linspace(-1, 1, nbx),
-                                         indexing='ij')
-    window = multivariate_normal.pdf(np.column_stack([grid_z.flat, grid_y.flat, grid_x.flat]), mean=mu, cov=covariance)
-    window = window.reshape((nbz, nby, nbx))
+    # the covariance is diagonal, the 3D gaussian is the product of three 1D gaussians. The normalization factor
+    # of the probability density is omitted since the apodized data is rescaled afterwards.
+    grid_z = np.linspace(-1, 1, nbz)[:, np.newaxis, np.newaxis]
+    grid_y = np.linspace(-1, 1, nby)[np.newaxis, :, np.newaxis]
+    grid_x = np.linspace(-1, 1, nbx)[np.newaxis, np.newaxis, :]
+    window = np.exp(-0.5 * ((grid_z - mu[0])**2 / sigma[0]**2 + (grid_y - mu[1])**2 / sigma[1]**2 +
+                            (grid_x - mu[2])**2 / sigma[2]**2))
 elif window_type == 'tukey':
     comment = comment + '_tukey'
     window = pu.tukey_window(data.shape, alpha=alpha)
@@ -72,6 +74,7 @@ elif window_type == 'blackman':
 else:
     print('invalid window type')
     sys.exit()
+window = window.astype(np.float32, copy=False)  # same dtype as data, the multiplication stays in single precision
 
 if debug:
     fig, ax0 = plt.subplots(1, 1)
@@ -102,22 +105,27 @@ if debug:
     # ax.spines['top'].set_linewidth(1.5)
     # ax.spines['bottom'].set_linewidth(1.5)
     # plt.savefig(datadir + 'windows_labels.png', bbox_inches="tight")
-new_data = np.multiply(data, window)
-new_data = new_data * maxdata / new_data.max()
+if debug:  # keep the initial data for the difference plot
+    new_data = np.multiply(data, window)
+else:  # the initial data is not needed anymore, apodize in place
+    new_data = np.multiply(data, window, out=data)
+new_data *= maxdata / new_data.max()  # rescale in place, the scalar factor is computed first
 
 print(new_data.max())
 plt.figure()
-plt.subplot(1, 2, 1)
-plt.imshow(np.log10(new_data.sum(axis=0)), vmin=0, vmax=6)
+if debug:
+    plt.subplot(1, 2, 1)
+plt.imshow(new_data.sum(axis=0), norm=LogNorm(vmin=1, vmax=1e6))
 plt.colorbar()
 plt.title('Apodized diffraction pattern')
-plt.subplot(1, 2, 2)
-plt.imshow((new_data-data).sum(axis=0))
-plt.colorbar()
-plt.title('(Apodized - initial) diffraction pattern')
+if debug:
+    plt.subplot(1, 2, 2)
+    plt.imshow((new_data-data).sum(axis=0))
+    plt.colorbar()
+    plt.title('(Apodized - initial) diffraction pattern')
 plt.pause(0.1)
 
-np.savez_compressed(datadir + comment + '.npz', data=new_data)
+np.savez(datadir + comment + '.npz', data=new_data)  # apodized intensities barely compress, skip the slow zlib pass
 
 plt.ioff()
 plt.show()
@@ -185,7 +185,7 @@ def press_key(event):
     :return: updated data, mask and controls
     """
     global original_data, data, mask, temp_mask, dim, idx, width, flag_aliens, flag_mask, flag_pause, max_colorbar
-    global xy, points, fig_mask, masked_color
+    global xy, fig_mask, masked_color
 
     try:
         if flag_aliens:
@@ -197,7 +197,7 @@ def press_key(event):
             data, temp_mask, flag_pause, xy, width, vmax, stop_masking = \
                 pru.update_mask(key=event.key, pix=int(np.rint(event.xdata)), piy=int(np.rint(event.ydata)),
                                 original_data=original_data, original_mask=mask, updated_data=data,
-                                updated_mask=temp_mask, figure=fig_mask, flag_pause=flag_pause, points=points,
+                                updated_mask=temp_mask, figure=fig_mask, flag_pause=flag_pause,
                                 xy=xy, width=width, dim=dim, vmin=0, vmax=max_colorbar, masked_color=masked_color)
         else:
             stop_masking = False
@@ -575,11 +575,8 @@ for scan_nb in range(len(scans)):
 
         # in XY
         dim = 0
-        x, y = np.meshgrid(np.arange(nx), np.arange(ny))
-        x, y = x.flatten(), y.flatten()
-        points = np.stack((x, y), axis=0).T
         xy = []  # list of points for mask
-        temp_mask = np.zeros((ny, nx))
+        temp_mask = np.zeros((ny, nx), dtype=np.uint8)
         data[mask == 1] = masked_color / nz  # will appear as -1 on the plot
         print('Select vertices of mask. Press a to restart;p to plot; q to quit.')
         fig_mask = plt.figure()
@@ -594,19 +591,15 @@ for scan_nb in range(len(scans)):
         plt.show()
         data = np.copy(original_data)
 
-        for idx in range(nz):
-            temp_array = mask[idx, :, :]
-            temp_array[np.nonzero(temp_mask)] = 1  # enough, numpy array is mutable hence mask will be modified
+        # the 2D mask is broadcast along the axis 0, nonzero values are masked
+        np.copyto(mask, True, where=np.expand_dims(temp_mask != 0, axis=0))
         del temp_mask
 
         # in XZ
         dim = 1
         flag_pause = False  # press x to pause for pan/zoom
-        x, y = np.meshgrid(np.arange(nx), np.arange(nz))
-        x, y = x.flatten(), y.flatten()
-        points = np.stack((x, y), axis=0).T
         xy = []  # list of points for mask
-        temp_mask = np.zeros((nz, nx))
+        temp_mask = np.zeros((nz, nx), dtype=np.uint8)
         data[mask == 1] = masked_color / ny  # will appear as -1 on the plot
         print('Select vertices of mask. Press a to restart;p to plot; q to quit.')
         fig_mask = plt.figure()
@@ -621,19 +614,15 @@ for scan_nb in range(len(scans)):
         plt.show()
         data = np.copy(original_data)
 
-        for idx in range(ny):
-            temp_array = mask[:, idx, :]
-            temp_array[np.nonzero(temp_mask)] = 1  # enough, numpy array is mutable hence mask will be modified
+        # the 2D mask is broadcast along the axis 1, nonzero values are masked
+        np.copyto(mask, True, where=np.expand_dims(temp_mask != 0, axis=1))
         del temp_mask
 
         # in YZ
         dim = 2
         flag_pause = False  # press x to pause for pan/zoom
-        x, y = np.meshgrid(np.arange(ny), np.arange(nz))
-        x, y = x.flatten(), y.flatten()
-        points = np.stack((x, y), axis=0).T
         xy = []  # list of points for mask
-        temp_mask = np.zeros((nz, ny))
+        temp_mask = np.zeros((nz, ny), dtype=np.uint8)
         data[mask == 1] = masked_color / nx  # will appear as -1 on the plot
         print('Select vertices of mask. Press a to restart;p to plot; q to quit.')
         fig_mask = plt.figure()
@@ -647,9 +636,8 @@ for scan_nb in range(len(scans)):
         fig_mask.set_facecolor(background_plot)
         plt.show()
 
-        for idx in range(nx):
-            temp_array = mask[:, :, idx]
-            temp_array[np.nonzero(temp_mask)] = 1  # enough, numpy array is mutable hence mask will be modified
+        # the 2D mask is broadcast along the axis 2, nonzero values are masked
+        np.copyto(mask, True, where=np.expand_dims(temp_mask != 0, axis=2))
         del temp_mask, dim
 
         data = original_data
@@ -9,7 +9,8 @@
 import hdf5plugin  # for P10, should be imported before h5py or PyTables
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
+from matplotlib.colors import LogNorm
+from scipy.interpolate import CubicSpline
 import sys
 sys.path.append('D:/myscripts/bcdi/')
 import bcdi.experiment.experiment_utils as exp
@@ -29,6 +30,7 @@ root_folder = "D:/data/CH5309/"
 sample_name = "S"  # "S"
 save_mask = False  # set to True to save the mask
 fit_rockingcurve = True  # set to True if you want a fit of the rocking curve
+roi_half_width = 50  # half width in pixels of the ROI around the Bragg peak used for the rocking curve
 ######################################
 # define beamline related parameters #
 ######################################
@@ -111,12 +113,8 @@ print('Data shape: ', numz, numy, numx)
 if data.ndim == 3 and fit_rockingcurve:
     tilt, _, _, _ = pru.motor_values(frames_logical=frames_logical, logfile=logfile, scan_number=scan, setup=setup,
                                      follow_bragg=False)
-    rocking_curve = np.zeros(numz)
-
-    z0, y0, x0 = pru.find_bragg(data, peak_method=peak_method)
-    z0 = np.rint(z0).astype(int)
-    y0 = np.rint(y0).astype(int)
-    x0 = np.rint(x0).astype(int)
+    # round half to even like np.rint, Python ints are stored in bragg_position
+    z0, y0, x0 = [round(float(val)) for val in pru.find_bragg(data, peak_method=peak_method)]
 
     if len(bragg_position) == 0:  # Bragg peak position not defined by te user, find the max
         bragg_position.append(y0)
@@ -124,18 +122,20 @@ if data.ndim == 3 and fit_rockingcurve:
 
     print("Bragg peak (full detector) at (z, y, x): ", z0, y0, x0)
 
-    for idx in range(numz):
-        rocking_curve[idx] = data[idx, bragg_position[0] - 50:bragg_position[0] + 50,
-                                  bragg_position[1] - 50:bragg_position[1] + 50].sum()
+    # a single ROI is summed, reading only its pixels is cheaper than an integral image of the whole stack
+    roi = data[:, bragg_position[0] - roi_half_width:bragg_position[0] + roi_half_width,
+               bragg_position[1] - roi_half_width:bragg_position[1] + roi_half_width]  # view, no copy
+    rocking_curve = roi.sum(axis=(1, 2), dtype=np.float64)
     plot_title = "Rocking curve for a ROI centered on (y, x): " + str(bragg_position[0]) + ',' + str(bragg_position[1])
 
     z0 = np.unravel_index(rocking_curve.argmax(), rocking_curve.shape)[0]
 
-    interpolation = interp1d(tilt, rocking_curve, kind='cubic')
+    order = np.argsort(tilt)  # the rocking angle can be scanned in both directions, CubicSpline needs it increasing
+    interpolation = CubicSpline(tilt[order], rocking_curve[order])
     interp_points = 5 * numz
     interp_tilt = np.linspace(tilt.min(), tilt.max(), interp_points)
     interp_curve = interpolation(interp_tilt)
-    interp_fwhm = len(np.argwhere(interp_curve >= interp_curve.max() / 2)) * \
+    interp_fwhm = np.count_nonzero(interp_curve >= interp_curve.max() / 2) * \
                   (tilt.max() - tilt.min()) / (interp_points - 1)
     print('FWHM by interpolation', str('{:.3f}'.format(interp_fwhm)), 'deg')
 
@@ -167,11 +167,12 @@ gu.combined_plots(tuple_array=(monitor, mask), tuple_sum_frames=False, tuple_sum
                   ylabel=('Counts (a.u.)', ''))
 
 y0, x0 = np.unravel_index(abs(data).argmax(), data.shape)
-print("Max at (y, x): ", y0, x0, ' Max = ', int(data[y0, x0]))
+max_data = int(data[y0, x0])
+print("Max at (y, x): ", y0, x0, ' Max = ', max_data)
 
 fig = plt.figure()
-plt.imshow(np.log10(data), vmin=0)
-plt.title('data.sum(axis=0)\nMax at (y, x): (' + str(y0) + ',' + str(x0) + ')   Max = ' + str(int(data[y0, x0])))
+plt.imshow(data, norm=LogNorm(vmin=1))  # the log scale is applied by the colormap
+plt.title('data.sum(axis=0)\nMax at (y, x): (' + str(y0) + ',' + str(x0) + ')   Max = ' + str(max_data))
 plt.colorbar()
 plt.savefig(detector.datadir + 'sum_S' + str(scan) + '.png')
 plt.show()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# BCDI: tools for pre(post)-processing Bragg coherent X-ray diffraction imaging data
+#   (c) 07/2017-06/2019 : CNRS UMR 7344 IM2NP
+#       authors:
+#         Jerome Carnis, jerome.carnis@esrf.fr
+
+import contextlib
+import io
+import unittest
+import numpy as np
+import bcdi.preprocessing.preprocessing_utils as pru
+
+
+class TestCheckPixels(unittest.TestCase):
+    """
+    Tests related to pru.check_pixels.
+    """
+    def test_long_scan_constant_pixels(self):
+        # pixels constant along a long scan (detector gaps filled with a non-integer flatfield value) should be the
+        # only masked pixels, pixels without intensity should not be masked
+        for dtype in (np.float32, np.float64):
+            with self.subTest(dtype=dtype):
+                rng = np.random.default_rng(0)
+                data = rng.poisson(5, (500, 64, 64)).astype(dtype)
+                data[:, :, 30:32] = (rng.random((64, 2)) * 2).astype(dtype)  # gap filled with the flatfield value
+                data[:, 20:24, :] = 0  # empty band
+                data[:, 40:44, :] = 0  # empty band
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _, mask = pru.check_pixels(data=data, mask=np.zeros((64, 64)))
+                expected = np.zeros((64, 64))
+                expected[:, 30:32] = 1
+                expected[20:24, :] = 0
+                expected[40:44, :] = 0
+                np.testing.assert_array_equal(mask, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()